@@ -5,6 +5,8 @@ should be renamed
 """
 
 import random 
+import itertools
+from collections.abc import MutableMapping
 import networkx as nx
 import dynamics_network as dn
 
@@ -12,18 +14,128 @@ BALANCE = dn.BALANCE
 
 # Definition of a Banking Node 
 
+''' All debts of a network, every debt stored once. Every bank has an index
+    in the ledger, and the debt between the banks with index i <= j is in
+    the row of i, as seen from i: rows[i][bank j]. lower[j] has the banks
+    i < j that j has a debt with, so that every bank can go through its
+    neighbours. Every bank starts with a ledger of its own, and the ledgers
+    of two banks are merged when they get a debt with each other. '''
+class Ledger(object):
+    __slots__ = ['banks', 'rows', 'lower']
+
+    def __init__(self):
+        self.banks = []
+        self.rows = []
+        self.lower = []
+
+    def add(self, bank):
+        bank.ledger, bank.index = self, len(self.banks)
+        self.banks.append(bank)
+        self.rows.append({})
+        self.lower.append([])
+
+    ''' Move the banks of the smaller ledger into the bigger one, behind its
+        own banks, and return the bigger one '''
+    def merge(self, other):
+        if len(self.banks) < len(other.banks):
+            return other.merge(self)
+        offset = len(self.banks)
+        for bank in other.banks:
+            bank.ledger = self
+            bank.index += offset
+        self.banks += other.banks
+        self.rows += other.rows
+        self.lower += other.lower
+        return self
+
+    ''' Set the debt between two banks of this ledger to amount, as seen from bank '''
+    def setDebt(self, bank, neighbour, amount):
+        if neighbour.index < bank.index:
+            bank, neighbour, amount = neighbour, bank, -amount
+        row = self.rows[bank.index]
+        if not neighbour in row and not neighbour is bank:
+            self.lower[neighbour.index].append(bank)
+        row[neighbour] = amount
+
+    ''' Add the debts of bank with banks of this ledger that it has no debt
+        with yet, as (neighbour, debt as seen from bank) '''
+    def addDebts(self, bank, debts):
+        rows, lower, i = self.rows, self.lower, bank.index
+        for neighbour, amount in debts:
+            j = neighbour.index
+            if i < j:
+                rows[i][neighbour] = amount
+                lower[j].append(bank)
+            elif i > j:
+                rows[j][bank] = -amount
+                lower[i].append(neighbour)
+            else:
+                rows[i][bank] = amount
+
+''' A set of banks with O(1) add and remove, that can be listed in random
+    order in time proportional to its size '''
+class RandomSet(object):
+    __slots__ = ['items', 'positions']
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def add(self, item):
+        if not item in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        position = self.positions.pop(item, None)
+        if position is not None:
+            # Move the last item into the hole
+            last = self.items.pop()
+            if not last is item:
+                self.items[position] = last
+                self.positions[last] = position
+
+    ''' The items in random order, as a new list. rng is anything with a
+        shuffle, like the random module or a dn.RandomStream '''
+    def sample(self, rng = random):
+        items = self.items[:]
+        rng.shuffle(items)
+        return items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
 class Bank(object):
+    __slots__ = ['label', 'capital', 'liquidity', 'bankruptcy', 'infection', 'ledger', 'index', 'neighbours', 'delta',
+                 'injection', 'rich_neighbours', 'money_lost', 'position', 'borrowers', 'lenders',
+                 'checking', 'total_debt', 'stats', 'indexed', '_borrowers', '_lenders',
+                 'active', 'changed']
+    # Not pickled, made again when needed
+    _unpickled = ['neighbours', 'indexed', '_borrowers', '_lenders', 'active', 'changed']
+
     def __init__(self, node, amount_inhand, amount_withothers = []):
         self.label = node
         self.capital = sum(amount_withothers) + amount_inhand
         self.liquidity = amount_inhand
         self.bankruptcy = False
         self.infection = False
-        self.neighbours = {}
+        Ledger().add(self)  # Sets the ledger with the debts and the index of self in it
+        self.neighbours = DebtView(self)  # neighbour : debt as seen from this bank, like the dictionary it used to be
         self.delta = 0
         self.injection = 0
         self.rich_neighbours = []
         self.money_lost = 0
+        self.checking = False  # While checking (see startChecking), every transfer, loseMoney and reset checks the ledger of the banks it touches
+        self.total_debt = 0
+        self.changed = None  # While checking, the set (of the whole network) that the banks are added to when their ledger changes
+        self.stats = None  # While a simulation records stats (see dn.SimulationStats), every transfer is counted in it
+        # The borrowers and lenders are kept up to date as the debts change, from the first time they
+        # are needed on (see _index)
+        self.indexed = False
+        self.active = None  # While a simulation schedules (see startScheduling), the dn.ActiveBanks to tell about every change
 
     ''' GET FUNCTIONS '''
     def getInfection(self):
@@ -57,7 +169,7 @@ class Bank(object):
         return self.lenders
     
     def getDebt(self, neighbour):
-        return abs(self.neighbours[neighbour])
+        return abs(self._amount(neighbour))
     
     def getRichNeighbours(self):
         return self.rich_neighbours
@@ -67,7 +179,12 @@ class Bank(object):
     
     ''' SET FUNCTIONS '''
     def setBankruptcy(self, value):
-        self.bankruptcy = value
+        if not value == self.bankruptcy:
+            self.bankruptcy = value
+            # Bankrupt banks aren't borrowers or lenders of anyone
+            for neighbour in self._neighbours():
+                if neighbour.indexed:
+                    neighbour._classify(self)
         self.infection = value
     
     def setPosition(self, pos):
@@ -75,60 +192,121 @@ class Bank(object):
     
     def setLiquidity(self, liq):
         self.liquidity = liq
+        self._moneyChanged()
     
     def setCapital(self, chng):
         self.capital = chng
+        self._moneyChanged()
 
-    def setBorrowers(self, borrowers):
-        random.shuffle(borrowers)
+    def setBorrowers(self, borrowers, rng = random):
+        rng.shuffle(borrowers)
         self.borrowers = borrowers      #Borrowers is unsorted 
     
-    def setLenders(self, lenders):
-        random.shuffle(lenders)
+    def setLenders(self, lenders, rng = random):
+        rng.shuffle(lenders)
         self.lenders = lenders    #Lenders is unsorted
     
     def setNoDebt(self):
-        for neighbour in self.neighbours:
-            self.neighbours[neighbour] = 0
-            neighbour.neighbours[self] = 0
+        for neighbour in self._neighbours():
+            if self.checking:
+                neighbour.total_debt += self._amount(neighbour)
+            self.ledger.setDebt(self, neighbour, 0)
+            self._debtChanged(neighbour)
+        if self.checking:
+            self.total_debt = 0
     
-    def setRichNeighbours(self, rich_neighbours):
-        random.shuffle(rich_neighbours)
+    def setRichNeighbours(self, rich_neighbours, rng = random):
+        rng.shuffle(rich_neighbours)
         self.rich_neighbours = rich_neighbours
         
     ''' CHANGE FUNCTIONS for += type addition '''
     def changeLiquidity(self, chng):
         self.liquidity += chng
+        self._moneyChanged()
 
     def changeCapital(self, chng):
         self.capital += chng
+        self._moneyChanged()
+
+    ''' Both at once, like the perturbation of a step (one update instead of two) '''
+    def changeLiquidityAndCapital(self, chng):
+        self.liquidity += chng
+        self.capital += chng
+        self._moneyChanged()
     
+    ''' The debt of the neighbour to self changes with it, since it is stored once '''
     def changeDebt(self, neighbour, debt):
-        self.neighbours[neighbour] += debt
+        if self.index <= neighbour.index:
+            self.ledger.rows[self.index][neighbour] += debt
+        else:
+            self.ledger.rows[neighbour.index][self] -= debt
+        if self.checking:
+            self.total_debt += debt
+            neighbour.total_debt -= debt
+        self._debtChanged(neighbour)
         
 
-    ''' Update functions don't take arguments. They are called and iterate through
-        neighbors to set borrowers/lenders/broke neighbors, and set them internally
-        without returning anything '''
-    def updateBorrowersLenders(self):
-        borrowers = []
-        lenders = []
-        for neighbour in self.getNeighbours():
-            value = self.neighbours[neighbour]
-            if value > 0 and (neighbour.getBankruptcy() is False):# and neighbour.getInfection() is False):
-                borrowers.append(neighbour)
-                
-            elif value < 0 and (neighbour.getBankruptcy() is False):# and neighbour.getInfection() is False):
-                lenders.append(neighbour)
-        self.setBorrowers(borrowers)
-        self.setLenders(lenders)
-    
-    def updateRichNeighbours(self):
-        rich_neighbours = []
-        for neighbour in self.neighbours:
-            if neighbour.getCapital() > BALANCE and neighbour.getLiquidity() > BALANCE:
-                rich_neighbours.append(neighbour) 
-        self.setRichNeighbours(rich_neighbours)
+    ''' Update functions don't take arguments. They set the borrowers/lenders/
+        rich neighbors internally, in random order, without returning anything.
+        The borrowers and lenders are kept up to date all the time, so that
+        only shuffles them (with rng, the random module or a dn.RandomStream).
+        Whether a neighbour is rich changes with nearly every transfer, so
+        the rich neighbours are looked up when they are asked for. '''
+    def updateBorrowersLenders(self, rng = random):
+        if not self.indexed:
+            self._index()
+        self.borrowers = self._borrowers.sample(rng)      #Borrowers is unsorted 
+        self.lenders = self._lenders.sample(rng)    #Lenders is unsorted
+    
+    def updateRichNeighbours(self, rng = random):
+        self.setRichNeighbours([neighbour for neighbour in self._neighbours()
+                                if neighbour.capital > BALANCE and neighbour.liquidity > BALANCE], rng)
+
+    ''' Build the borrowers and lenders from scratch. After this they are
+        kept up to date by _classify. '''
+    def _index(self):
+        self._borrowers, self._lenders = RandomSet(), RandomSet()
+        self.indexed = True
+        for neighbour in self._neighbours():
+            self._classify(neighbour)
+
+    ''' Put a neighbour in the borrowers or lenders of self (the ones that
+        aren't bankrupt and owe self, or that self owes), or in neither.
+        Nothing happens if it is already where it belongs, which is most of
+        the time, since most transfers don't change who owes whom. '''
+    def _classify(self, neighbour):
+        value = 0 if neighbour.bankruptcy else self._amount(neighbour)
+        borrowers, lenders = self._borrowers, self._lenders
+        if value > 0:
+            if neighbour in borrowers.positions:
+                return
+            borrowers.add(neighbour)
+            lenders.discard(neighbour)
+        elif value < 0:
+            if neighbour in lenders.positions:
+                return
+            lenders.add(neighbour)
+            borrowers.discard(neighbour)
+        elif neighbour in borrowers.positions:
+            borrowers.discard(neighbour)
+        elif neighbour in lenders.positions:
+            lenders.discard(neighbour)
+        else:
+            return
+        if self.active is not None:
+            self.active.update(self)
+
+    ''' After the debt between self and a neighbour changed '''
+    def _debtChanged(self, neighbour):
+        if self.indexed:
+            self._classify(neighbour)
+        if neighbour.indexed:
+            neighbour._classify(self)
+
+    ''' After the liquidity or capital changed '''
+    def _moneyChanged(self):
+        if self.active is not None:
+            self.active.update(self)
         
     ''' MISCELLANEOUS FUNCTIONS '''
     
@@ -136,8 +314,11 @@ class Bank(object):
     def transfer(self, neighbour, money):  #money is +ve when self to neighbour and -ve when it is neighbour to self
         self.changeLiquidity(-money)
         neighbour.changeLiquidity(money)
-        self.changeDebt(neighbour, money)
-        neighbour.changeDebt(self, -money)
+        self.changeDebt(neighbour, money)  # Also changes the debt of neighbour to self
+        if self.checking:
+            self.checkLedger(neighbour)
+        if self.stats is not None:
+            self.stats.countTransfer(money)
         
     def lenderBorrowerSame(self):
         for neighbour in self.getNeighbours():
@@ -146,9 +327,28 @@ class Bank(object):
 
     ''' This function is for network generation only.  '''
     def putNeighbours(self, neighbours, amount_withothers):
-        self.neighbours = dict(zip(neighbours, amount_withothers))
+        for neighbour, amount in zip(neighbours, amount_withothers):
+            self.putDebt(neighbour, amount)
         self.updateBorrowersLenders()
 
+    ''' Set the debt with a neighbour to amount as seen from self, making it a
+        neighbour first if it isn't one yet '''
+    def putDebt(self, neighbour, amount):
+        if not neighbour.ledger is self.ledger:
+            self.ledger.merge(neighbour.ledger)
+        self.ledger.setDebt(self, neighbour, amount)
+        self._debtChanged(neighbour)
+
+    ''' The debt with a neighbour as seen from self '''
+    def _amount(self, neighbour):
+        if self.index <= neighbour.index:
+            return self.ledger.rows[self.index][neighbour]
+        return -self.ledger.rows[neighbour.index][self]
+
+    ''' The neighbours in the row of self, then the ones with a lower index '''
+    def _neighbours(self):
+        return itertools.chain(self.ledger.rows[self.index], self.ledger.lower[self.index])
+
     ''' Set infection to false '''
     def cure(self):
         self.infection = False
@@ -163,21 +363,26 @@ class Bank(object):
 
     ''' DESCRIPTION '''
     def loseMoney(self, bank):
-        self.money_lost += self.getDebt(bank)
-        self.changeCapital(-self.getDebt(bank))
-        bank.changeDebt(self, self.getDebt(bank))
-        self.changeDebt(bank, -self.getDebt(bank))
+        debt = self.getDebt(bank)
+        self.money_lost += debt
+        self.changeCapital(-debt)
+        self.changeDebt(bank, -debt)  # Also clears the debt of bank to self
+        if self.checking:
+            self.checkLedger(bank)
          
                 
     ''' Reset all attributes of a bank (used after bankruptcy avalanche is over) '''
     def reset(self):
-        self.bankruptcy = False
-        self.infection = False
+        self.setBankruptcy(False)  # Also cures
         self.capital = BALANCE
         self.liquidity = BALANCE
+        self._moneyChanged()
         self.setNoDebt()
         self.injection = False
         self.money_lost = 0
+        if self.checking:
+            for neighbour in self._neighbours():
+                self.checkLedger(neighbour)
 
     ''' Debugging function I think. Used to check if the capital still equals the liquidity + loans/debts. '''
     def isCapitalRight(self):
@@ -185,6 +390,45 @@ class Bank(object):
             print(self)
             raise Exception("Capital isn't right!")
             
+    ''' Start keeping a running total of the debts, so that checkLedger takes
+        O(1) instead of summing over all neighbours. If changed is given (a
+        set), every bank whose ledger is checked is added to it, so the
+        banks that changed can be audited (see dn._audit_changed) '''
+    def startChecking(self, changed = None):
+        self.total_debt = self.getTotalDebt()
+        self.checking = True
+        self.changed = changed
+
+    def stopChecking(self):
+        self.checking = False
+        self.changed = None
+
+    ''' Keep active (a dn.ActiveBanks) up to date about self: every change of
+        the liquidity, capital, borrowers or lenders is passed on to it '''
+    def startScheduling(self, active):
+        if not self.indexed:
+            self._index()
+        self.active = active
+        active.update(self)
+
+    def stopScheduling(self):
+        self.active = None
+
+    ''' Check the ledger between self and a neighbour after a change: both
+        have to be in the same Ledger, and the capital of both still has to
+        equal the liquidity + loans/debts. Bankrupt banks are skipped, their
+        ledger is only right again after the reset. '''
+    def checkLedger(self, neighbour):
+        if not self.ledger is neighbour.ledger or not neighbour in self.neighbours:
+            raise Exception("This doesn't make senseB!")
+        for bank in (self, neighbour):
+            if not bank.bankruptcy and not bank.capital == bank.liquidity + bank.total_debt:
+                print(bank)
+                raise Exception("Capital isn't right!")
+        if self.changed is not None:
+            self.changed.add(self)
+            self.changed.add(neighbour)
+
     ''' This gets invoked when doing print(node). Print usefull stuff instead of node reference memory address '''
     def __str__(self):
         out = "Node %d has %d capital and %d liquidity. " %(self.getLabel(), self.getCapital(), self.getLiquidity())
@@ -192,6 +436,64 @@ class Bank(object):
             out += " %d debt to node %d. " % (self.neighbours[n], n.getLabel())
         return out
 
+    ''' Pickling. The neighbours view and the borrowers and lenders are made
+        again after unpickling '''
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__ if not name in self._unpickled and hasattr(self, name))
+
+    def __setstate__(self, state):
+        self.checking, self.total_debt, self.stats = False, 0, None
+        self.indexed, self.active, self.changed = False, None, None
+        for name, value in state.items():
+            if name in self.__slots__ and not name in self._unpickled:
+                setattr(self, name, value)
+        # Pickles from before the Ledger (like the ones in MEAN_FIELD_SAVED) have a dictionary of neighbours
+        # instead. Every debt is put in the ledger by the second of its banks to be unpickled.
+        if not 'ledger' in state:
+            Ledger().add(self)
+            debts = [(neighbour, amount) for neighbour, amount in state['neighbours'].items() if hasattr(neighbour, 'ledger')]
+            # In the order of the debts, so the indexes don't depend on where the ledgers are in memory
+            for neighbour, _ in debts:
+                if not neighbour.ledger is self.ledger:
+                    self.ledger.merge(neighbour.ledger)
+            self.ledger.addDebts(self, debts)
+        self.neighbours = DebtView(self)
+
+''' The debts of a bank as a dictionary of neighbour : debt as seen from the
+    bank, which is what Bank.neighbours used to be. Reads and writes go to
+    the Ledger, so writing a debt also changes it for the neighbour. '''
+class DebtView(MutableMapping):
+    __slots__ = ['bank']
+
+    def __init__(self, bank):
+        self.bank = bank
+
+    def __getitem__(self, neighbour):
+        if not neighbour in self:
+            raise KeyError(neighbour)
+        return self.bank._amount(neighbour)
+
+    def __setitem__(self, neighbour, amount):
+        self.bank.putDebt(neighbour, amount)
+
+    def __delitem__(self, neighbour):
+        raise Exception("Debts can't be removed, set them to 0 instead.")
+
+    def __iter__(self):
+        return self.bank._neighbours()
+
+    def __len__(self):
+        ledger, index = self.bank.ledger, self.bank.index
+        return len(ledger.rows[index]) + len(ledger.lower[index])
+
+    def __contains__(self, neighbour):
+        bank = self.bank
+        if not getattr(neighbour, 'ledger', None) is bank.ledger:
+            return False
+        if bank.index <= neighbour.index:
+            return neighbour in bank.ledger.rows[bank.index]
+        return bank in bank.ledger.rows[neighbour.index]
+
 def createAdjacencyMatrix(network):
     """
     Returning the adjacency matrix of the network
@@ -8,6 +8,7 @@ This script is where we define the functions for network analysis.
 import networkx as nx
 import matplotlib.pyplot as plt
 import numpy as np
+import topology_network as tn
 
 ''' Print the capital, liquidity and loans/debts for every node '''
 def print_network(network):
@@ -21,25 +22,144 @@ def print_node_list(node_list):
         print(node)
     print('\n')
 
-''' Plot a histogram of the avalanche sizes '''
-def histogram_avalanches(avalanche_sizes, avalanche_sizes2 = None, num_bins = 50, y_scale = 'log', x_scale = 'log'):
-    results_histogram = np.histogram(avalanche_sizes, bins=num_bins)
-    plt.plot(np.linspace(0, max(avalanche_sizes), num_bins), results_histogram[0], '*')
-    if not avalanche_sizes2 is None:
-        results_histogram = np.histogram(avalanche_sizes2, bins=num_bins)
-        plt.plot(np.linspace(0, max(avalanche_sizes2), num_bins), results_histogram[0], '*')
+''' Plot a histogram of the avalanche sizes. The avalanche sizes can be lists
+    or AvalancheStatistics. When x_scale is 'log', logarithmic bins are used
+    (and the counts are divided by the bin width) '''
+def histogram_avalanches(avalanche_sizes, avalanche_sizes2 = None, num_bins = 50, y_scale = 'log', x_scale = 'log', labels = None):
+    for i, sizes in enumerate([avalanche_sizes, avalanche_sizes2]):
+        if sizes is None:
+            continue
+        if not isinstance(sizes, AvalancheStatistics):
+            statistics = AvalancheStatistics()
+            statistics.addMany(sizes)
+            sizes = statistics
+        if x_scale == 'log':
+            edges, counts = sizes.getLogHistogram()
+            x = np.sqrt(edges[:-1] * edges[1:])
+            y = counts / np.diff(edges)
+        else:
+            x, y = sizes.getHistogram(num_bins)
+        label = None if labels is None else labels[i]
+        plt.plot(x[y > 0], y[y > 0], '*', label=label)
     plt.yscale(y_scale)
     plt.xscale(x_scale)
     plt.xlabel("Avalanche Size")
     plt.ylabel("Frequency")
+    if not labels is None:
+        plt.legend()
     plt.show()
 
+''' Accumulator for the distribution of avalanche sizes. Adding an avalanche
+    costs O(1), so the sizes themselves don't have to be stored. It keeps the
+    exact count of every size and the running moments, and the log-binned
+    histogram and tail counts follow from the exact counts. Statistics of
+    different replicas or processes can be merged (and pickled). Feed it the
+    sizes of dn.iterate_simulation one by one with add, or a list of sizes
+    with addMany. Steps without an avalanche (size -1) are skipped by both,
+    avalanches of size 0 are counted, like in dn.run_simulation. '''
+class AvalancheStatistics(object):
+    def __init__(self):
+        self.counts = np.zeros(64, dtype=np.int64)  # counts[s] is the number of avalanches of size s
+        self.n = 0  # number of avalanches
+        self.total = 0  # sum of the sizes
+        self.total_squares = 0  # sum of the squared sizes
+
+    ''' ADD FUNCTIONS '''
+    def add(self, size):
+        if size < 0:
+            return
+        if size >= len(self.counts):
+            self._grow(size)
+        self.counts[size] += 1
+        self.n += 1
+        self.total += size
+        self.total_squares += size * size
+
+    def addMany(self, sizes):
+        sizes = np.asarray(sizes, dtype=np.int64)
+        sizes = sizes[sizes >= 0]
+        if len(sizes) == 0:
+            return
+        counts = np.bincount(sizes)
+        self._grow(len(counts) - 1)
+        self.counts[:len(counts)] += counts
+        self.n += len(sizes)
+        self.total += int(np.sum(sizes))
+        self.total_squares += int(np.sum(sizes * sizes))
+
+    ''' Add the statistics of another accumulator to this one '''
+    def merge(self, other):
+        self._grow(len(other.counts) - 1)
+        self.counts[:len(other.counts)] += other.counts
+        self.n += other.n
+        self.total += other.total
+        self.total_squares += other.total_squares
+        return self
+
+    ''' GET FUNCTIONS '''
+    def getCount(self):
+        return self.n
+
+    def getMax(self):
+        return int(np.flatnonzero(self.counts)[-1]) if self.n > 0 else 0
+
+    ''' The mean, variance and moments are nan if nothing was added '''
+    def getMean(self):
+        if self.n == 0:
+            return float('nan')
+        return self.total / self.n
+
+    def getVariance(self):
+        if self.n == 0:
+            return float('nan')
+        return self.total_squares / self.n - self.getMean()**2
+
+    ''' The k-th raw moment, the mean of size**k '''
+    def getMoment(self, k):
+        if self.n == 0:
+            return float('nan')
+        sizes = np.arange(len(self.counts), dtype=np.float64)
+        return np.sum(self.counts * sizes**k) / self.n
+
+    ''' Sizes that occurred and how often, or with num_bins linear bins
+        the bin centers and the counts '''
+    def getHistogram(self, num_bins = None):
+        if num_bins is None:
+            sizes = np.flatnonzero(self.counts)
+            return sizes, self.counts[sizes]
+        sizes = np.arange(len(self.counts))
+        counts, edges = np.histogram(sizes, bins=num_bins, range=(0, self.getMax() + 1), weights=self.counts)
+        return (edges[:-1] + edges[1:]) / 2, counts
+
+    ''' Logarithmic bins [base**b, base**(b+1)) starting at size 1, returns
+        the bin edges and the counts. Avalanches of size 0 aren't in any bin '''
+    def getLogHistogram(self, base = 2):
+        max_bin = int(np.floor(np.log(max(self.getMax(), 1)) / np.log(base) + 1e-9))
+        edges = base**np.arange(max_bin + 2, dtype=np.float64)
+        sizes = np.arange(1, len(self.counts))
+        bins = np.floor(np.log(sizes) / np.log(base) + 1e-9).astype(np.int64)
+        counts = np.bincount(bins, weights=self.counts[1:], minlength=max_bin + 1)[:max_bin + 1]
+        return edges, counts.astype(np.int64)
+
+    ''' Number of avalanches with a size of at least each of the thresholds '''
+    def getTailCounts(self, thresholds):
+        tail = np.cumsum(self.counts[::-1])[::-1]
+        return np.array([tail[x] if x < len(tail) else 0 for x in thresholds], dtype=np.int64)
+
+    ''' Make room for sizes up to size '''
+    def _grow(self, size):
+        if size >= len(self.counts):
+            counts = np.zeros(max(size + 1, 2 * len(self.counts)), dtype=np.int64)
+            counts[:len(self.counts)] = self.counts
+            self.counts = counts
+
 def plot_network(network):
     pos=nx.circular_layout(network)
     nx.draw_networkx_edges(network, pos=pos, alpha=.1, edge_color='k')
     nx.draw_networkx_nodes(network, pos=pos, node_color = 'b', node_size = 1)
     plt.show()
 
+''' Average degree, from the topology index (so it is only computed once) '''
 def calc_average_degree(network):
-    return np.mean(list(network.degree().values()))
+    return tn.topology_index(network).getMeanDegree()
 
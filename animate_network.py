@@ -1,11 +1,12 @@
+import collections
 import generate_network as gn
 import dynamics_network as dn
 import analyze_network as an
+import topology_network as tn
 import networkx as nx
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
-import random
 
 def get_node_colours(network):
     to_return = []
@@ -53,8 +54,6 @@ def get_edge_colours(network):
     return np.array(to_return)
     
 
-random.seed(1)
-
 
 def gen_graph(network, defaults):
     to_return = nx.DiGraph()
@@ -97,8 +96,8 @@ def gen_graph(network, defaults):
     return to_return
      
 
-def graph_plot(network, step, node_size, font_size, label_edges = True):
-    dn.run_simulation(network, step)
+def graph_plot(network, step, node_size, font_size, label_edges = True, seed = 1):
+    dn.run_simulation(network, step, seed = seed)
     
     G = gen_graph(network, [])
     # edges = G.edges()
@@ -126,8 +125,9 @@ def graph_plot(network, step, node_size, font_size, label_edges = True):
     
 
 
-def animate_simulation(network, node_size):
-    dn.step_simulation(network)
+def animate_simulation(network, node_size, seed = 1):
+    rng = dn.RandomStream(seed)
+    dn.step_simulation(network, rng = rng)
 
     fig = plt.figure(figsize=(5,5))
     fig.gca().set_xlim(left=-1.1, right=1.1)
@@ -150,7 +150,7 @@ def animate_simulation(network, node_size):
         fig.gca().set_ylim(bottom=-1.1, top=1.1)
         plt.axis("off")
 
-        defaults = dn.step_simulation(network)
+        defaults = dn.step_simulation(network, rng = rng)
         plt.title(str(n))
         G = gen_graph(network, defaults)
         node_color = [G.node[n]['color'] for n in G.nodes()]
@@ -174,35 +174,45 @@ def default_graph(defaults, network):
         for i in network.neighbors(n):
             if G.has_node(i):
                 G.add_edge(*(n, i))
-    starts = []
-    for n in G.nodes():
-        if G.in_degree(n) == 0:
-            starts.append(n)
+    # Start from the defaults nothing points to, then from the ones left on cycles
+    starts = [n for n in G.nodes() if G.in_degree(n) == 0] + G.nodes()
 
     to_return = []
+    visited = set()
     for n in starts:
+        if n in visited:
+            continue
+        visited.add(n)
         to_return.append(n)
-        z = []
-        z.append(n)
+        z = collections.deque([n])
         while (len(z) > 0):
-            h = z.pop(0)
-            for i in G.neighbors(h):
-                z.append(i)
-                to_return.append(i)
+            h = z.popleft()
+            for i in G.successors(h):
+                if not i in visited:
+                    visited.add(i)
+                    z.append(i)
+                    to_return.append(i)
     print (len(to_return))
     # nx.draw(G)
     # plt.show()
     return to_return
 
-def animate_defaults(network, avalanche_size, node_size):
-    dn.step_simulation(network)
-    defaults = []
-    while (len(defaults) < avalanche_size):
+''' The banks of an avalanche in the order it reached them, from its cascade
+    (see cn.Cascade), which was recorded while it spread '''
+def cascade_order(cascade, network):
+    nodes = tn.topology_index(network).nodes
+    return [nodes[i] for i in cascade.banks.tolist()]
+
+def animate_defaults(network, avalanche_size, node_size, seed = 1):
+    rng = dn.RandomStream(seed)
+    dn.step_simulation(network, rng = rng)
+    cascades = []
+    while (len(cascades) == 0 or len(cascades[-1].banks) < avalanche_size):
         G = gen_graph(network, [])
-        defaults = dn.step_simulation(network)
-        defaults = set(defaults.tolist())
+        dn.step_simulation(network, rng = rng, cascades = cascades)
 
-    d = default_graph(defaults, G)
+    d = cascade_order(cascades[-1], network)
+    frames = len(d)
 
     fig = plt.figure(figsize=(5,5))
     fig.gca().set_xlim(left=-1.1, right=1.1)
@@ -245,7 +255,7 @@ def animate_defaults(network, avalanche_size, node_size):
 
         return nodes, edges, edges2
 
-    ani = FuncAnimation(fig, update, interval=1000, frames=len(defaults))
+    ani = FuncAnimation(fig, update, interval=1000, frames=frames)
     plt.show()
  
 G = gn.regular_network(L = 7, d = 2, Tl = -4, Ts = -6)
@@ -0,0 +1,921 @@
+# -*- coding: utf-8 -*-
+""" ===========================================================================
+
+This script is an array-backed version of the dynamical rules in
+dynamics_network. Instead of walking Bank objects one by one, the capital,
+liquidity, infection and bankruptcy of all banks are kept in NumPy arrays and
+the debts are kept in a CSR edge array built from the network.
+
+The rules and the parameters (quick_repaying, diversify_trade,
+panic_collection, too_big_to_fail) are the same as in dynamics_network, so
+run_simulation can be swapped in for dn.run_simulation in main. On top of
+those, clearing_cascade (which uses scipy.sparse) only exists here.
+
+Only the parts of a step that don't depend on the order of the banks are
+vectorized. repay_debts, collect_loans and ask_for_investments give the banks
+their turns one by one in a random order, and every transfer changes what the
+next banks can do. Two banks could only take their turns at once if they had
+no counterparty in common, and in a mean field network every pair of banks
+has one, so these phases stay sequential (see Turns). They take most of a
+step, so run_simulation is about as fast as dn.run_simulation on small or
+sparse networks and at most a few times faster on big dense ones, not an
+order of magnitude.
+
+=========================================================================== """
+
+import heapq
+import numpy as np
+import scipy.sparse as sp
+import dynamics_network as dn
+import topology_network as tn
+import cascade_network as cn
+
+UNIT = dn.UNIT
+BALANCE = dn.BALANCE
+DELTA = dn.DELTA
+
+''' Up to this many counterparties, a bank splits its budget with the plain
+    lists of dn, which is quicker than with arrays (see _split_evenly) '''
+SPLIT_WITH_LISTS = 100
+
+''' The arrays of BankArrays that change during a simulation '''
+STATE = ['debt', 'capital', 'liquidity', 'bankruptcy', 'infection', 'delta',
+         'injection', 'money_lost', 'hubs_with_loan']
+
+''' The state of the whole network as arrays.
+    Every undirected edge e between banks u[e] and v[e] stores its debt once,
+    in debt[e]. A positive debt means that v[e] owes money to u[e], ie it is
+    what u[e] would store in Bank.neighbours[v[e]].
+    The CSR arrays (indptr, nbr, eid, sgn) list for every bank i the slots
+    indptr[i]:indptr[i+1], with the neighbour, the edge and the sign to apply
+    to debt[edge] to get the debt as seen from bank i.
+    Tl and Ts are stored already multiplied with UNIT.
+    csr can be a tuple (indptr, owner, nbr, eid, sgn) that was built before,
+    for example memory-mapped from disk, so it doesn't have to be rebuilt. '''
+class BankArrays(object):
+    def __init__(self, N, u, v, Tl, Ts, debt = None, degree = None, csr = None):
+        u = np.asarray(u, dtype=np.int64)
+        v = np.asarray(v, dtype=np.int64)
+        E = len(u)
+        self.N = N
+        self.Tl = Tl
+        self.Ts = Ts
+        # Per bank state
+        self.capital = np.zeros(N, dtype=np.int64) + BALANCE
+        self.liquidity = np.zeros(N, dtype=np.int64) + BALANCE
+        self.bankruptcy = np.zeros(N, dtype=bool)
+        self.infection = np.zeros(N, dtype=bool)
+        self.delta = np.zeros(N, dtype=np.int64)
+        self.injection = np.zeros(N, dtype=np.int64)
+        self.money_lost = np.zeros(N, dtype=np.int64)
+        self.hubs_with_loan = np.zeros(N, dtype=bool)
+        # Per edge state
+        self.u = u
+        self.v = v
+        if debt is None:
+            self.debt = np.zeros(E, dtype=np.int64)
+        else:
+            self.debt = np.asarray(debt, dtype=np.int64).copy()
+        # CSR index, every edge appears once in the slots of both its banks
+        if csr is None:
+            owner = np.concatenate((u, v))
+            order = np.argsort(owner, kind='mergesort')
+            self.owner = owner[order]
+            self.nbr = np.concatenate((v, u))[order]
+            self.eid = np.concatenate((np.arange(E), np.arange(E)))[order]
+            self.sgn = np.concatenate((np.ones(E, dtype=np.int64), -np.ones(E, dtype=np.int64)))[order]
+            self.indptr = np.zeros(N + 1, dtype=np.int64)
+            self.indptr[1:] = np.cumsum(np.bincount(owner, minlength=N))
+        else:
+            self.indptr, self.owner, self.nbr, self.eid, self.sgn = csr
+        # The degree is used to find the hubs for the too big to fail policy
+        if degree is None:
+            degree = np.diff(self.indptr)
+        self.degree = np.asarray(degree)
+        self.hub_masks = {}  # (criterion, k) : mask, see getHubMask
+
+    ''' Which banks are hubs (see tn.hub_mask), computed once per criterion '''
+    def getHubMask(self, criterion = "mean", k = 1):
+        if not (criterion, k) in self.hub_masks:
+            self.hub_masks[(criterion, k)] = tn.hub_mask(self.degree, criterion, k)
+        return self.hub_masks[(criterion, k)]
+
+    ''' Debts of all slots as seen from the owner of the slot '''
+    def getViews(self):
+        return self.sgn * self.debt[self.eid]
+
+    ''' Debts of the slots of bank i as seen from bank i '''
+    def getView(self, i):
+        k0, k1 = self.indptr[i], self.indptr[i + 1]
+        return self.sgn[k0:k1] * self.debt[self.eid[k0:k1]]
+
+""" ===========================================================================
+
+CONVERSION BETWEEN NETWORKS OF BANK OBJECTS AND ARRAYS
+
+=========================================================================== """
+
+''' Build the arrays from a network of Bank objects (as made by
+    generate_network). Tl and Ts are read from network.graph and multiplied
+    with UNIT, just like dn.run_simulation does. '''
+def from_network(network):
+    nodes = network.nodes()
+    index = dict(zip(nodes, range(len(nodes))))
+    u, v, debt = [], [], []
+    for a, b in network.edges():
+        # Self loops never carry debt
+        if a is b:
+            continue
+        u.append(index[a])
+        v.append(index[b])
+        debt.append(a.getNeighboursDict()[b])
+    degree = [network.degree(node) for node in nodes]
+    state = BankArrays(len(nodes), u, v, network.graph['Tl'] * UNIT, network.graph['Ts'] * UNIT, debt, degree)
+    for i, node in enumerate(nodes):
+        state.capital[i] = node.getCapital()
+        state.liquidity[i] = node.getLiquidity()
+        state.bankruptcy[i] = node.getBankruptcy()
+        state.infection[i] = node.getInfection()
+        state.delta[i] = node.delta
+        state.injection[i] = node.injection
+        state.money_lost[i] = node.getMoneyLost()
+    for hub in network.graph.get('hubs_with_loan', []):
+        state.hubs_with_loan[index[hub]] = True
+    return state
+
+''' Build the arrays straight from an edge list, like the one from
+    gn.mean_field_edges, without building a networkx graph first. Every one
+    of the N banks is kept, also the ones without edges. Tl and Ts are
+    multiplied with UNIT. Self loops never carry debt so they are dropped,
+    but they count for the degree like in networkx. '''
+def from_edges(N, u, v, Tl, Ts):
+    u = np.asarray(u, dtype=np.int64)
+    v = np.asarray(v, dtype=np.int64)
+    degree = np.bincount(u, minlength=N) + np.bincount(v, minlength=N)
+    keep = u != v
+    return BankArrays(N, u[keep], v[keep], Tl * UNIT, Ts * UNIT, degree = degree)
+
+''' Write the state in the arrays back into the Bank objects of the network
+    it was built from, so the network can be analyzed or animated as usual. '''
+def to_network(state, network):
+    nodes = network.nodes()
+    for i, node in enumerate(nodes):
+        node.setCapital(int(state.capital[i]))
+        node.setLiquidity(int(state.liquidity[i]))
+        node.setBankruptcy(bool(state.bankruptcy[i]))
+        node.infection = bool(state.infection[i])
+        node.delta = int(state.delta[i])
+        node.injection = int(state.injection[i])
+        node.money_lost = int(state.money_lost[i])
+    for e in range(len(state.debt)):
+        a, b = nodes[state.u[e]], nodes[state.v[e]]
+        a.neighbours[b] = int(state.debt[e])  # b sees the same debt
+    network.graph['hubs_with_loan'] = [nodes[i] for i in np.flatnonzero(state.hubs_with_loan)]
+    return network
+
+''' Take a snapshot of everything a simulation changes: the capital,
+    liquidity, debts, injection and flags of every bank, and the graph
+    attributes. network is a network of Bank objects or BankArrays. Use
+    restore to go back to the snapshot instead of loading the network again. '''
+def snapshot(network):
+    if isinstance(network, BankArrays):
+        return dict((name, getattr(network, name).copy()) for name in STATE), {'Tl' : network.Tl, 'Ts' : network.Ts}
+    graph = dict(network.graph)
+    for key in graph:
+        if isinstance(graph[key], list):
+            graph[key] = list(graph[key])
+    return from_network(network), graph
+
+''' Put a network back in the state of a snapshot, in place. For BankArrays
+    this is just copying the arrays back, for a network of Bank objects every
+    bank and edge is written again. '''
+def restore(network, snap):
+    state, graph = snap
+    if isinstance(network, BankArrays):
+        for name in STATE:
+            getattr(network, name)[:] = state[name]
+        network.Tl, network.Ts = graph['Tl'], graph['Ts']
+    else:
+        to_network(state, network)
+        network.graph.clear()
+        for key in graph:
+            network.graph[key] = list(graph[key]) if isinstance(graph[key], list) else graph[key]
+    return network
+
+""" ===========================================================================
+
+SIMULATION
+
+=========================================================================== """
+
+''' Run the simulation for T iterations. network is either a network of Bank
+    objects or BankArrays. When it is a network of Bank objects, the final
+    state is written back into it. Unlike dn.run_simulation, the thresholds in
+    network.graph are left as they are. If cascades is a list, the cn.Cascade
+    of every avalanche is appended to it. '''
+def run_simulation(network, T, parameters = None, DEBUG_BOOL = False, seed = None, cascades = None):
+    avalanche_sizes = []  # list of the sizes of all avalanches
+    for t, avalanche_size, depth in iterate_simulation(network, T, parameters, DEBUG_BOOL, seed, cascades):
+        if avalanche_size >= 0:
+            avalanche_sizes.append(avalanche_size)
+    return avalanche_sizes
+
+''' Run the simulation for T iterations as a generator, which yields
+    (step, avalanche size, cascade depth) after every step, like
+    dn.iterate_simulation. Steps without an avalanche yield size -1 and
+    depth 0. It can be used with dn.stream_simulation. '''
+def iterate_simulation(network, T, parameters = None, DEBUG_BOOL = False, seed = None, cascades = None):
+    # If no parameters were input, just use the default parameters
+    if parameters is None:
+        parameters = dn.default_parameters
+    print(parameters)
+    if isinstance(network, BankArrays):
+        state = network
+    else:
+        state = from_network(network)
+    print("Tl is %i and Ts is %i" % (state.Tl // UNIT, state.Ts // UNIT))
+    rng = np.random.RandomState(seed)
+
+    try:
+        # Simulation kernel
+        for t in range(T):
+            avalanche_sizes, avalanche_depths = [], []
+            _step(state, parameters, rng, avalanche_sizes, avalanche_depths, t, DEBUG_BOOL, cascades)
+            if len(avalanche_sizes) > 0:
+                yield t, avalanche_sizes[0], avalanche_depths[0]
+            else:
+                yield t, -1, 0
+    finally:
+        if not isinstance(network, BankArrays):
+            to_network(state, network)
+
+''' One step of the simulation '''
+def _step(state, parameters, rng, avalanche_sizes, avalanche_depths, t, DEBUG_BOOL = False, cascades = None):
+    if t % 50 == 0:
+        print("ITERATION %i" % t)
+    # Generate random perturbations in the liquidity for each node
+    perturb(state, rng)
+
+    # If the "too big to fail" policy is being implemented, hubs check if they can repay their government loan
+    if parameters['too_big_to_fail']:
+        _repay_government_loan(state)
+
+    # Banks with surplus liquidity try to repay debts
+    repay_debts(state, parameters, rng)
+
+    # Banks with a deficit try to collect loans back
+    collect_loans(state, parameters, rng)
+
+    # Banks with negative liquidity ask neighbors with surpluses to invest in them
+    ask_for_investments(state, parameters, rng)
+
+    # Check for bankruptcy and propagate infection/failures
+    check_and_propagate_avalanche(state, avalanche_sizes, parameters, rng, avalanche_depths, cascades)
+
+    # just checking the correctness of the program:
+    if DEBUG_BOOL:
+        debug(state)
+
+''' Each bank gets or loses some capital randomly (delta=1 v delta=-1) '''
+def perturb(state, rng):
+    delta = (2 * rng.randint(0, 2, state.N) - 1) * DELTA
+    state.liquidity += delta
+    state.capital += delta
+    state.delta[:] = delta
+
+''' Banks with surplus liquidity repay debts '''
+def repay_debts(state, parameters, rng):
+    if dn._get_parameter(parameters, 'synchronous_settlement'):
+        _repay_debts_synchronously(state, parameters, rng)
+        return
+    paying = state.liquidity > BALANCE
+    if parameters['quick_repaying']:
+        paying |= (state.liquidity < BALANCE) & (state.delta > 0)
+    turns = Turns(state.N, paying & _owners(state, state.getViews() < 0), rng)
+    for i in turns:
+        liquidity = state.liquidity[i]
+        # Repay debt to lenders if I have a surplus
+        if liquidity > BALANCE:
+            k, view = _lenders(state, i, rng)
+            if len(k) == 0:
+                continue
+            debt = -view
+            if parameters['diversify_trade'] == False:
+                # Repay lenders one after another until I run out of money
+                money = np.clip(liquidity - BALANCE - (np.cumsum(debt) - debt), 0, debt)
+            elif parameters['diversify_trade'] == True:
+                money = _split_evenly(debt, liquidity - BALANCE, parameters)
+            else:
+                raise Exception("Parameter doesn't exist. (Spelled wrong probably)")
+            _transfer(state, i, k, money)
+            turns.touch(state.nbr[k])
+        # If this node is broke, but 'quick_repaying' is on, and we got some money this round, pay back a random debt
+        elif liquidity < BALANCE and parameters['quick_repaying'] and state.delta[i] > 0:
+            k, view = _lenders(state, i, rng)
+            if len(k) > 0:
+                _transfer(state, i, k[:1], state.delta[i:i + 1])
+                turns.touch(state.nbr[k[:1]])
+
+''' Banks with negative liquidity collect loans '''
+def collect_loans(state, parameters, rng):
+    if dn._get_parameter(parameters, 'synchronous_settlement'):
+        _collect_loans_synchronously(state, parameters, rng)
+        return
+    turns = Turns(state.N, (state.liquidity < BALANCE) & _owners(state, state.getViews() > 0), rng)
+    for i in turns:
+        liquidity = state.liquidity[i]
+        if liquidity < BALANCE:
+            k, debt = _borrowers(state, i, rng)
+            if len(k) == 0:
+                continue
+            money_needed = abs(liquidity)
+            if parameters['diversify_trade'] == False:
+                # Take back whole loans until a loan is bigger than what I need, then take what I need from that one
+                money = debt.copy()
+                too_big = np.flatnonzero(debt > money_needed)
+                if len(too_big) > 0:
+                    money[too_big[0]] = money_needed
+                    money[too_big[0] + 1:] = 0
+            elif parameters['diversify_trade'] == True:
+                money = _split_evenly(debt, BALANCE - liquidity, parameters)
+            else:
+                raise Exception("Parameter doesn't exist. (Spelled wrong probably)")
+            _transfer(state, i, k, -money)
+            turns.touch(state.nbr[k])
+
+''' Banks with negative liquidity ask neighbors with surpluses to invest in them '''
+def ask_for_investments(state, parameters, rng):
+    if dn._get_parameter(parameters, 'synchronous_settlement'):
+        _ask_for_investments_synchronously(state, parameters, rng)
+        return
+    # Banks only stop being rich in this phase, so the ones without rich neighbours now never get any
+    asking = (state.liquidity < BALANCE) & (state.capital < BALANCE)
+    rich = (state.capital > BALANCE) & (state.liquidity > BALANCE)
+    turns = Turns(state.N, asking & _owners(state, rich[state.nbr]), rng)
+    for i in turns:
+        liquidity = state.liquidity[i]
+        if liquidity < BALANCE and state.capital[i] < BALANCE:
+            k = _rich_neighbours(state, i, rng)
+            if len(k) == 0:
+                continue
+            surplus = state.liquidity[state.nbr[k]]
+            if parameters['diversify_trade'] == False:
+                # Take all the surplus of rich neighbours until I have what I need
+                money = np.clip(BALANCE - liquidity - (np.cumsum(surplus) - surplus), 0, surplus)
+            elif parameters['diversify_trade'] == True:
+                money = _split_evenly(surplus - BALANCE, BALANCE - liquidity, parameters)
+            else:
+                raise Exception("Parameter doesn't exist. (Spelled wrong probably.)")
+            _transfer(state, i, k, -money)
+            turns.touch(state.nbr[k])
+
+''' Check for bankruptcy and spread infections. The size of an avalanche is
+    the number of infected (but not bankrupt) banks when it stops growing.
+    Only the start scans all banks. After that, only banks that lost capital
+    or liquidity are checked for bankruptcy, and only newly infected banks
+    collect their loans, so an avalanche costs time in proportion to its size.
+    With too_big_to_fail, the hubs that lost money with their injection are
+    checked in the first round too (see _inject_hubs).
+    If avalanche_depths is given, the number of rounds is appended to it, and
+    if cascades is given, the cn.Cascade of the avalanche (who infected whom,
+    recorded as the infections happen) is appended to it. '''
+def check_and_propagate_avalanche(state, avalanche_sizes, parameters, rng, avalanche_depths = None, cascades = None):
+    # If any bank has gone bankrupt, start an infection
+    bankrupt_banks = _find_bankruptcies(state)
+    if len(bankrupt_banks) > 0:
+        _propagate_avalanche(state, bankrupt_banks, avalanche_sizes, parameters, rng, avalanche_depths, cascades)
+
+''' Spread the infection from the given banks, which were just marked as
+    bankrupt (and infected), until the avalanche stops, and reset the
+    bankrupt banks afterwards '''
+def _propagate_avalanche(state, bankrupt_banks, avalanche_sizes, parameters, rng, avalanche_depths = None, cascades = None):
+    if dn._get_parameter(parameters, 'clearing_cascade'):
+        if cascades is not None:
+            raise Exception("The clearing cascade has no rounds of infections, so it can't record cascades.")
+        _clear_avalanche(state, bankrupt_banks, avalanche_sizes, parameters, rng, avalanche_depths)
+        return
+    all_bankrupt_banks = [bankrupt_banks]
+    cascade = None
+    if cascades is not None:
+        cascade = cn.Cascade()
+        cascade.addBankruptcies(bankrupt_banks)
+        cascade.nextRound()
+
+    # Lenders of bankrupt banks lose their loans and get infected
+    lenders, new_infections = _infect_neighbours(state, bankrupt_banks, cascade)
+    all_infections = [new_infections]
+    length_old_infections = len(new_infections)
+
+    if length_old_infections > 0:
+        # If we're doing the 'too big to fail' policy, inject hubs with money
+        rechecked = np.zeros(0, dtype=np.int64)  # Banks to check for bankruptcy besides the lenders and borrowers
+        if parameters['too_big_to_fail']:
+            rechecked = _inject_hubs(state, rng, parameters)
+        rounds = 0
+        while True:
+            rounds += 1
+            if cascade is not None:
+                cascade.nextRound()
+            # Newly infected banks collect money from borrowers and infect them, then new bankruptcies happen
+            borrowers, infected_borrowers = _collect_money_and_spread_infection(state, new_infections, cascade)
+            # The lenders and borrowers are infected, but a rechecked hub can go bankrupt without having been
+            # infected, and then it was never counted
+            healthy = rechecked[~state.infection[rechecked]]
+            bankrupt_banks = _find_new_bankruptcies(state, np.concatenate((lenders, borrowers, rechecked)))
+            infected_bankruptcies = len(bankrupt_banks) - np.count_nonzero(np.in1d(bankrupt_banks, healthy))
+            rechecked = rechecked[:0]
+            if cascade is not None:
+                cascade.addBankruptcies(bankrupt_banks)
+            lenders, infected_lenders = _infect_neighbours(state, bankrupt_banks, cascade)
+            all_bankrupt_banks.append(bankrupt_banks)
+            new_infections = np.concatenate((infected_borrowers, infected_lenders))
+            new_infections = new_infections[~state.bankruptcy[new_infections]]
+            all_infections.append(new_infections)
+
+            # Check if there are new infections and if avalanche should be stopped
+            length_new_infections = length_old_infections + len(infected_borrowers) + len(infected_lenders) - infected_bankruptcies
+            if length_new_infections == length_old_infections:
+                avalanche_sizes.append(int(length_new_infections))
+                if avalanche_depths is not None:
+                    avalanche_depths.append(rounds)
+                if cascade is not None:
+                    cascades.append(cascade.finish())
+                state.infection[np.concatenate(all_infections)] = False  # Cures infected banks
+                _reset_all(state, np.concatenate(all_bankrupt_banks))
+                break
+            else:
+                length_old_infections = length_new_infections
+    else:
+        _reset_all(state, bankrupt_banks)
+
+''' Check that the avalanche sizes are the numbers of infected banks that
+    didn't go bankrupt, which the cascades count from who infected whom. This
+    runs with too_big_to_fail, whose hubs can go bankrupt without being
+    infected. The network isn't changed. '''
+def check_avalanche_sizes(network, T = 500, seed = 0):
+    parameters = dict(dn.default_parameters)
+    parameters['too_big_to_fail'] = True
+    cascades = []
+    state = network if isinstance(network, BankArrays) else from_network(network)
+    avalanche_sizes = run_simulation(state, T, parameters, seed = seed, cascades = cascades)
+    for t, (size, cascade) in enumerate(zip(avalanche_sizes, cascades)):
+        if not size == cascade.getSize():
+            raise Exception("Avalanche %i has size %i, but %i banks were infected and didn't go bankrupt!" % (t, size, cascade.getSize()))
+
+''' Check that the capital equals the liquidity + loans/debts for every bank,
+    and that no bank is borrowing and lending at the same time. '''
+def debug(state):
+    view = state.getViews()
+    total_debt = np.zeros(state.N, dtype=np.int64)
+    np.add.at(total_debt, state.owner, view)
+    if not np.array_equal(state.capital, total_debt + state.liquidity):
+        raise Exception("Capital isn't right!")
+    lending = np.zeros(state.N, dtype=bool)
+    borrowing = np.zeros(state.N, dtype=bool)
+    lending[state.owner[view > 0]] = True
+    borrowing[state.owner[view < 0]] = True
+    if (lending & borrowing).any():
+        raise Exception("A node is borrowing and lending at the same time. This shouldn't happen!")
+
+""" ===========================================================================
+
+HELPER FUNCTIONS
+
+=========================================================================== """
+
+''' Transfer money[n] from bank i to the neighbour in slot k[n], and update
+    the debt. money is +ve when it goes from i to the neighbour, and -ve when
+    it goes from the neighbour to i (like Bank.transfer) '''
+def _transfer(state, i, k, money):
+    state.liquidity[i] -= money.sum()
+    # A bank has every neighbour in only one slot, so there are no repeated indices
+    state.liquidity[state.nbr[k]] += money
+    state.debt[state.eid[k]] += state.sgn[k] * money
+
+''' Slots of the lenders of bank i in random order, and the debts to them
+    (-ve) as seen from i. Bankrupt banks are reset at the end of every
+    avalanche, so no lender is bankrupt when this is called. '''
+def _lenders(state, i, rng):
+    k0 = state.indptr[i]
+    view = state.getView(i)
+    k = k0 + rng.permutation((view < 0).nonzero()[0])
+    return k, view[k - k0]
+
+''' Slots of the borrowers of bank i in random order, and their debts (+ve) '''
+def _borrowers(state, i, rng):
+    k0 = state.indptr[i]
+    view = state.getView(i)
+    k = k0 + rng.permutation((view > 0).nonzero()[0])
+    return k, view[k - k0]
+
+''' Slots of the neighbours of bank i with positive capital and liquidity, in
+    random order '''
+def _rich_neighbours(state, i, rng):
+    k0, k1 = state.indptr[i], state.indptr[i + 1]
+    nbr = state.nbr[k0:k1]
+    rich = (state.capital[nbr] > BALANCE) & (state.liquidity[nbr] > BALANCE)
+    return k0 + rng.permutation(rich.nonzero()[0])
+
+''' Split the budget evenly over the counterparties for diversify_trade,
+    either in closed form (see dn._even_split) or DELTA at a time (see
+    dn._round_robin), with lists or arrays (see SPLIT_WITH_LISTS) '''
+def _split_evenly(caps, budget, parameters):
+    if len(caps) <= SPLIT_WITH_LISTS:
+        return np.array(dn._split_budget(caps.tolist(), int(budget), parameters), dtype=np.int64)
+    return _split_evenly_in_groups(caps, np.zeros(len(caps), dtype=np.int64), np.array([budget]), parameters)
+
+''' Whether every bank owns a slot where keep is true '''
+def _owners(state, keep):
+    return np.bincount(state.owner[keep], minlength=state.N) > 0
+
+''' The turns of the banks in a sequential phase: the order of
+    rng.permutation(N), but only the banks that can act get a turn. can_act
+    says which banks can at the start of the phase. A bank can only start
+    to be able to act when a transfer touches it, so the banks that a
+    transfer touches (see touch) get a turn too, if theirs is still to come,
+    and check again. The banks that act, and what they do, are the same as
+    when every bank gets a turn, since a bank that can't act draws no random
+    numbers. Like dn.Scheduler, with the places in the permutation as keys. '''
+class Turns(object):
+    def __init__(self, N, can_act, rng):
+        self.order = rng.permutation(N).tolist()
+        self.place = np.empty(N, dtype=np.int64)
+        self.place[self.order] = np.arange(N)
+        self.queue = np.sort(self.place[can_act]).tolist()  # A sorted list is a heap
+        self.queued = set(self.queue)
+        self.now = -1  # Place of the bank whose turn it is
+
+    def __iter__(self):
+        while len(self.queue) > 0:
+            self.now = heapq.heappop(self.queue)
+            yield self.order[self.now]
+
+    def touch(self, banks):
+        for place in self.place[banks].tolist():
+            if place > self.now and not place in self.queued:
+                self.queued.add(place)
+                heapq.heappush(self.queue, place)
+
+''' Slot indices of all the given banks, concatenated '''
+def _slots_of(state, banks):
+    starts = state.indptr[banks]
+    counts = state.indptr[banks + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return offsets + np.arange(counts.sum())
+
+''' ===========================================================================
+PAYMENTS OF MANY BANKS AT ONCE
+
+When many banks pay or collect at the same time, their slots are put one
+after another, and g says which bank (the group) a slot belongs to. The
+groups are sorted, so the slots of a group are next to each other. The
+budget of group g is budgets[g].
+=========================================================================== '''
+
+''' Cumulative sum of x within every group '''
+def _cumsum_in_groups(x, g):
+    total = np.cumsum(x)
+    return total - (total - x)[np.searchsorted(g, g)]
+
+''' Pay the caps one after another until the budget of the group is spent '''
+def _in_line_in_groups(caps, g, budgets):
+    return np.clip(budgets[g] - (_cumsum_in_groups(caps, g) - caps), 0, caps)
+
+''' Take back whole loans until a loan is bigger than what the group needs,
+    then take what it needs from that one (like collect_loans) '''
+def _whole_loans_in_groups(debt, g, money_needed):
+    money_needed = money_needed[g]
+    too_big = debt > money_needed
+    count = _cumsum_in_groups(too_big, g)
+    return np.where(count == 0, debt, np.where(too_big & (count == 1), money_needed, 0))
+
+''' _split_evenly for every group '''
+def _split_evenly_in_groups(caps, g, budgets, parameters):
+    if dn._get_parameter(parameters, 'closed_form_settlement'):
+        return _even_split_in_groups(caps, g, budgets)
+    return _round_robin_in_groups(caps, g, budgets)
+
+''' dn._even_split for every group. The units are sorted within every group
+    to find the number of full rounds that the budget pays for. '''
+def _even_split_in_groups(caps, g, budgets):
+    n = len(budgets)
+    if len(caps) == 0:
+        return np.zeros(0, dtype=np.int64)
+    units = np.maximum(-(-caps // DELTA), 0)  # Rounds a counterparty takes part in
+    units_left = np.maximum(-(-budgets // DELTA), 0)
+    # What it costs to give everybody up to the units of the i-th smallest (or all of them, when less)
+    order = np.lexsort((units, g))
+    s, gs = units[order], g[order]
+    first = np.searchsorted(gs, gs)
+    still_open = np.bincount(gs, minlength=n)[gs] - (np.arange(len(s)) - first)
+    cost = _cumsum_in_groups(s, gs) + (still_open - 1) * s
+    # Counterparties that get their cap, then the full rounds everybody else takes part in
+    capped = np.bincount(gs[cost <= units_left[gs]], minlength=n)
+    last = np.maximum(np.searchsorted(gs, np.arange(n)) + capped - 1, 0)
+    rounds = np.where(capped > 0, s[last], 0)
+    units_left = units_left - np.where(capped > 0, cost[last], 0)
+    open_banks = np.bincount(g, minlength=n) - capped
+    extra_units = np.where(open_banks > 0, units_left % np.maximum(open_banks, 1), 0)
+    rounds = rounds + np.where(open_banks > 0, units_left // np.maximum(open_banks, 1), 0)
+    # Everybody gets the full rounds, and the first ones in line get an extra unit
+    extra = (units > rounds[g]) & (_cumsum_in_groups(units > rounds[g], g) <= extra_units[g])
+    return (np.minimum(units, rounds[g]) + extra) * DELTA
+
+''' dn._round_robin for every group '''
+def _round_robin_in_groups(caps, g, budgets):
+    money = np.zeros(len(caps), dtype=np.int64)
+    budgets = budgets.copy()
+    while True:
+        still_open = (money < caps) & (budgets[g] > 0)
+        if not still_open.any():
+            break
+        given = still_open & (_cumsum_in_groups(still_open, g) <= -(-budgets // DELTA)[g])
+        money[given] += DELTA
+        budgets -= DELTA * np.bincount(g[given], minlength=len(budgets))
+    return money
+
+''' ===========================================================================
+SYNCHRONOUS SETTLEMENT
+
+With synchronous_settlement, every bank decides what it pays, collects or
+asks for from the state at the start of the phase, with the same rules as
+above, and then all transfers are made at once. In every phase only one of
+the two banks of an edge acts on it (the borrower repays, the lender
+collects, the poor bank asks), so the decisions never clash, except that a
+rich bank can be asked for money by several neighbours at once.
+=========================================================================== '''
+
+def _repay_debts_synchronously(state, parameters, rng):
+    view = state.getViews()
+    k = _shuffled_slots(state, view < 0, rng)
+    g = state.owner[k]
+    debt = -view[k]
+    money = np.zeros(len(k), dtype=np.int64)
+    # Repay debt to lenders if I have a surplus
+    paying = state.liquidity[g] > BALANCE
+    if parameters['diversify_trade'] == False:
+        money[paying] = _in_line_in_groups(debt[paying], g[paying], state.liquidity - BALANCE)
+    elif parameters['diversify_trade'] == True:
+        money[paying] = _split_evenly_in_groups(debt[paying], g[paying], state.liquidity - BALANCE, parameters)
+    else:
+        raise Exception("Parameter doesn't exist. (Spelled wrong probably)")
+    # If this node is broke, but 'quick_repaying' is on, and we got some money this round, pay back a random debt
+    if parameters['quick_repaying']:
+        first = (state.liquidity[g] < BALANCE) & (state.delta[g] > 0) & (np.arange(len(g)) == np.searchsorted(g, g))
+        money[first] = state.delta[g[first]]
+    _transfer_all(state, k, money)
+
+def _collect_loans_synchronously(state, parameters, rng):
+    view = state.getViews()
+    k = _shuffled_slots(state, (view > 0) & (state.liquidity[state.owner] < BALANCE), rng)
+    g = state.owner[k]
+    if parameters['diversify_trade'] == False:
+        money = _whole_loans_in_groups(view[k], g, np.abs(state.liquidity))
+    elif parameters['diversify_trade'] == True:
+        money = _split_evenly_in_groups(view[k], g, BALANCE - state.liquidity, parameters)
+    else:
+        raise Exception("Parameter doesn't exist. (Spelled wrong probably)")
+    _transfer_all(state, k, -money)
+
+def _ask_for_investments_synchronously(state, parameters, rng):
+    asking = (state.liquidity < BALANCE) & (state.capital < BALANCE)
+    rich = (state.capital > BALANCE) & (state.liquidity > BALANCE)
+    k = _shuffled_slots(state, asking[state.owner] & rich[state.nbr], rng)
+    g = state.owner[k]
+    surplus = state.liquidity[state.nbr[k]]
+    if parameters['diversify_trade'] == False:
+        money = _in_line_in_groups(surplus, g, BALANCE - state.liquidity)
+    elif parameters['diversify_trade'] == True:
+        money = _split_evenly_in_groups(surplus - BALANCE, g, BALANCE - state.liquidity, parameters)
+    else:
+        raise Exception("Parameter doesn't exist. (Spelled wrong probably.)")
+    _transfer_all(state, k, -_share_out(money, state.nbr[k], state.liquidity - BALANCE))
+
+''' The slots where keep is true, in random order within every bank '''
+def _shuffled_slots(state, keep, rng):
+    k = np.flatnonzero(keep)
+    return k[np.lexsort((rng.random_sample(len(k)), state.owner[k]))]
+
+''' Transfer money[n] from the owner of slot k[n] to the neighbour in it, for
+    all slots at once (money is -ve when it goes to the owner) '''
+def _transfer_all(state, k, money):
+    state.liquidity -= _scatter_add(state.owner[k], money, state.N)
+    state.liquidity += _scatter_add(state.nbr[k], money, state.N)
+    # No edge is acted on twice in a phase, so there are no repeated indices
+    state.debt[state.eid[k]] += state.sgn[k] * money
+
+''' Sum of the values for every index, as int64 (bincount gives floats, which
+    are exact for amounts of money like these) '''
+def _scatter_add(index, values, size):
+    return np.round(np.bincount(index, weights=values, minlength=size)).astype(np.int64)
+
+''' A bank that is asked for more than it has (available[giver]) gives every
+    bank that asked it its share of what it has, rounded down to DELTA so
+    that all money stays in units of DELTA '''
+def _share_out(asked, giver, available):
+    total = _scatter_add(giver, asked, len(available))[giver]
+    share = asked * available[giver] // np.maximum(total, 1) // DELTA * DELTA
+    return np.where(total > available[giver], share, asked)
+
+''' ===========================================================================
+AVALANCHE RELATED HELPER FUNCTIONS
+=========================================================================== '''
+
+''' Mark every bank below one of the thresholds as bankrupt (and infected),
+    and return these banks '''
+def _find_bankruptcies(state):
+    bankrupt_banks = np.flatnonzero((state.capital <= state.Ts) | (state.liquidity <= state.Tl))
+    state.bankruptcy[bankrupt_banks] = True
+    state.infection[bankrupt_banks] = True
+    return bankrupt_banks
+
+''' Same as _find_bankruptcies, but only for the given banks. Banks that
+    already are bankrupt are skipped '''
+def _find_new_bankruptcies(state, banks):
+    banks = np.unique(banks)
+    banks = banks[~state.bankruptcy[banks]]
+    bankrupt_banks = banks[(state.capital[banks] <= state.Ts) | (state.liquidity[banks] <= state.Tl)]
+    state.bankruptcy[bankrupt_banks] = True
+    state.infection[bankrupt_banks] = True
+    return bankrupt_banks
+
+''' The lenders of the given bankrupt banks that aren't bankrupt themselves
+    lose their loans and get infected. Returns these lenders, and the ones
+    among them that weren't infected yet. The infections are added to
+    cascade (a cn.Cascade) if it is given '''
+def _infect_neighbours(state, bankrupt_banks, cascade = None):
+    k = _slots_of(state, bankrupt_banks)
+    view = state.sgn[k] * state.debt[state.eid[k]]
+    k = k[(view < 0) & ~state.bankruptcy[state.nbr[k]]]
+    lenders = state.nbr[k]
+    lost = state.sgn[k] * state.debt[state.eid[k]]  # -ve, as seen from the bankrupt bank
+    if cascade is not None:
+        cascade.addInfections(state.owner[k], lenders, -lost)
+    np.add.at(state.money_lost, lenders, -lost)
+    np.add.at(state.capital, lenders, lost)
+    state.debt[state.eid[k]] = 0
+    return _infect(state, lenders)
+
+''' The given infected banks collect all their loans back from borrowers that
+    aren't bankrupt, and infect these borrowers. Every loan belongs to only
+    one of its two banks, so the order in which infected banks collect
+    doesn't matter and everything is done at once. Returns the borrowers, and
+    the ones among them that weren't infected yet (the infections are added
+    to cascade, if it is given) '''
+def _collect_money_and_spread_infection(state, infected_banks, cascade = None):
+    k = _slots_of(state, infected_banks)
+    view = state.sgn[k] * state.debt[state.eid[k]]
+    k = k[(view > 0) & ~state.bankruptcy[state.nbr[k]]]
+    money = state.sgn[k] * state.debt[state.eid[k]]
+    if cascade is not None:
+        cascade.addInfections(state.owner[k], state.nbr[k], money)
+    np.add.at(state.liquidity, state.owner[k], money)
+    np.add.at(state.liquidity, state.nbr[k], -money)
+    state.debt[state.eid[k]] = 0
+    return _infect(state, state.nbr[k])
+
+''' Set infection to true for the given banks, and return them together with
+    the ones that weren't infected before '''
+def _infect(state, banks):
+    banks = np.unique(banks)
+    new_infections = banks[~state.infection[banks]]
+    state.infection[new_infections] = True
+    return banks, new_infections
+
+''' Reset the given bankrupt banks and write off all their debts '''
+def _reset_all(state, banks):
+    state.capital[banks] = BALANCE
+    state.liquidity[banks] = BALANCE
+    state.injection[banks] = 0
+    state.money_lost[banks] = 0
+    state.bankruptcy[banks] = False
+    state.infection[banks] = False
+    state.debt[state.eid[_slots_of(state, banks)]] = 0
+
+''' ===========================================================================
+CLEARING CASCADE
+
+With clearing_cascade, an avalanche isn't spread round by round. Instead the
+banks that end up bankrupt are found as a fixed point, in the style of the
+clearing vector of Eisenberg and Noe:
+    - the lenders of bankrupt banks lose these loans and get infected,
+    - infected banks collect all their loans from borrowers that aren't
+      bankrupt, which infects these borrowers too,
+    - a bank is bankrupt if its capital or liquidity after all of this is
+      below the thresholds.
+Starting from the banks that just went bankrupt, this is worked out with
+sparse matrix-vector products on the matrix of loans, and the new
+bankruptcies are added until there are none. Unlike the rounds, a bank is
+judged on what it paid and collected in the whole avalanche at once. The
+avalanche size is the same (infected banks that aren't bankrupt), the depth
+is the number of times the bankruptcies were updated.
+=========================================================================== '''
+
+def _clear_avalanche(state, bankrupt_banks, avalanche_sizes, parameters, rng, avalanche_depths = None):
+    edges, lender, borrower, loan = _loans(state)
+    # loans[i, j] is what bank j owes to bank i, and borrowed[j, i] is the same loan
+    loans = sp.csr_matrix((loan, (lender, borrower)), shape=(state.N, state.N))
+    borrowed = sp.csr_matrix((loan, (borrower, lender)), shape=(state.N, state.N))
+    bankrupt = np.zeros(state.N, dtype=bool)
+    bankrupt[bankrupt_banks] = True
+    infected = _spread_infection(loans, borrowed, bankrupt, np.zeros(state.N, dtype=bool))
+    if not infected.any():
+        _reset_all(state, bankrupt_banks)
+        return
+    # If we're doing the 'too big to fail' policy, inject hubs with money
+    if parameters['too_big_to_fail']:
+        _inject_hubs(state, rng, parameters)
+    rounds = 0
+    while True:
+        rounds += 1
+        solvent = ~bankrupt
+        capital = state.capital - loans.dot(bankrupt.astype(np.int64))
+        liquidity = (state.liquidity + infected * loans.dot(solvent.astype(np.int64))
+                     - solvent * borrowed.dot(infected.astype(np.int64)))
+        new_bankrupt = bankrupt | (capital <= state.Ts) | (liquidity <= state.Tl)
+        if np.array_equal(new_bankrupt, bankrupt):
+            break
+        bankrupt = new_bankrupt
+        infected = _spread_infection(loans, borrowed, bankrupt, infected)
+
+    # Lenders of bankrupt banks lose their loans, infected banks collect the others
+    lost = bankrupt[borrower] & ~bankrupt[lender]
+    state.capital -= _scatter_add(lender[lost], loan[lost], state.N)
+    state.money_lost += _scatter_add(lender[lost], loan[lost], state.N)
+    collected = infected[lender] & ~bankrupt[borrower]
+    state.liquidity += _scatter_add(lender[collected], loan[collected], state.N)
+    state.liquidity -= _scatter_add(borrower[collected], loan[collected], state.N)
+    state.debt[edges[lost | collected]] = 0
+    avalanche_sizes.append(int(np.count_nonzero(infected)))
+    if avalanche_depths is not None:
+        avalanche_depths.append(rounds)
+    _reset_all(state, np.flatnonzero(bankrupt))
+
+''' Every edge with a debt, as (edge, lender, borrower, loan) arrays. Most
+    edges carry no debt, so the matrices are built from these only. '''
+def _loans(state):
+    edges = np.flatnonzero(state.debt)
+    debt = state.debt[edges]
+    lender = np.where(debt > 0, state.u[edges], state.v[edges])
+    borrower = np.where(debt > 0, state.v[edges], state.u[edges])
+    return edges, lender, borrower, np.abs(debt)
+
+''' Infect the lenders of bankrupt banks, then the borrowers of the newly
+    infected banks, and so on. Banks that were infected stay infected (like
+    in the rounds), but bankrupt banks don't count as infected. '''
+def _spread_infection(loans, borrowed, bankrupt, infected):
+    infected = (infected | (loans.dot(bankrupt.astype(np.int64)) > 0)) & ~bankrupt
+    new_infections = infected
+    while new_infections.any():
+        new_infections = (borrowed.dot(new_infections.astype(np.int64)) > 0) & ~bankrupt & ~infected
+        infected |= new_infections
+    return infected
+
+''' ===========================================================================
+TOO BIG TO FAIL
+=========================================================================== '''
+
+''' Inject all hubs with a temporary government loan. Returns the hubs whose
+    injection was negative: these lost money and can be past a threshold now '''
+def _inject_hubs(state, rng, parameters = None):
+    if parameters is None:
+        parameters = dn.default_parameters
+    hubs = state.getHubMask(dn._get_parameter(parameters, 'hub_criterion'), dn._get_parameter(parameters, 'hub_k'))
+    # injection size based on Karel's "policy implementations" file
+    injection = np.round(state.capital[hubs] - rng.normal(0.44, 0.26, np.count_nonzero(hubs)) * state.Ts).astype(np.int64)
+    state.injection[hubs] += injection
+    state.capital[hubs] += injection
+    state.liquidity[hubs] += injection
+    state.hubs_with_loan[:] = hubs  # Copied in place, the mask itself is kept for the next avalanche
+    # For a hub deep in debt (capital below fraction * Ts) the injection is negative and takes money
+    # away, like in the original policy. Then the hub has to be checked for bankruptcy again
+    return np.flatnonzero(hubs)[injection < 0]
+
+''' Hubs with a government loan repay it, or as much of it as they can.
+    dn._repay_government_loan removes the hubs that paid off their loan from
+    the list it is going through, so the hub after each of them is skipped
+    until the next step. That is done here too, to get the same dynamics. '''
+def _repay_government_loan(state):
+    # Works on R x N arrays of replicas too (see batch_network), every replica has its own list
+    in_line = np.flatnonzero(state.hubs_with_loan)
+    liquidity, injection = state.liquidity.reshape(-1)[in_line], state.injection.reshape(-1)[in_line]
+    paid_off = (liquidity > BALANCE) & (liquidity >= injection)
+    # In a run of hubs that pay off, every other one is skipped, and so is the hub after the last one done
+    position = np.arange(len(in_line))
+    new_list = np.ones(len(in_line), dtype=bool)
+    new_list[1:] = in_line[1:] // state.hubs_with_loan.shape[-1] > in_line[:-1] // state.hubs_with_loan.shape[-1]
+    run_start = np.maximum.accumulate(np.where(paid_off, np.where(new_list, position, 0), position + 1))
+    skipped = np.zeros(len(in_line), dtype=bool)
+    skipped[1:] = paid_off[:-1] & ((position - run_start)[:-1] % 2 == 0) & ~new_list[1:]
+    hubs = np.zeros(state.hubs_with_loan.shape, dtype=bool)
+    hubs.reshape(-1)[in_line[~skipped & (liquidity > BALANCE)]] = True
+    repay = np.minimum(state.liquidity[hubs], state.injection[hubs])
+    state.capital[hubs] -= repay
+    state.liquidity[hubs] -= repay
+    state.injection[hubs] -= repay
+    # Hubs that paid off their entire loan are done
+    state.hubs_with_loan[hubs] = state.injection[hubs] > 0
+
+
+if __name__ == '__main__':
+    print("Run the main you idiot!")
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+""" ===========================================================================
+
+This script is where we run many replicas of one network at the same time.
+Running the simulation R times means going through the same Python loops R
+times, which is most of the time for small networks (like the mean field
+network with N=100 in main). Here the replicas share the topology (the CSR
+arrays of array_network) and their state is kept as R x N arrays (capital,
+liquidity, ...) and an R x E array of debts. Then:
+    - the perturbation, the repayment of government loans and the check of
+      the thresholds Tl and Ts are done for all replicas at once,
+    - the settlement phases go through the banks in lockstep: in every
+      replica the n-th bank of its own random order acts at the same time,
+      so that every bank visit is a few NumPy operations for all replicas
+      together. Only the banks that can act in the phase are in the order,
+      so a phase takes as many visits as the busiest replica needs,
+    - only the replicas that have an avalanche go through the cascade, one
+      by one, with the functions of array_network.
+With synchronous_settlement, all banks of all replicas settle at once.
+The replicas follow the same rules as arn.run_simulation, but they draw from
+one random stream, so replica r isn't the same run as arn.run_simulation with
+some seed. Run it like:
+    avalanche_sizes = bn.run_simulation(network, T, replicas, parameters)
+which gives a list with the avalanche sizes of every replica.
+
+A visit costs more than one bank of arn, so this only pays off with enough
+replicas. On the mean field network with N=100 and the default parameters,
+a replica-step takes 0.9 ms with arn.run_simulation and here:
+    R = 1: 3.6 ms, R = 2: 2.5 ms, R = 4: 1.4 ms, R = 8: 0.93 ms,
+    R = 16: 0.80 ms, R = 32: 0.67 ms, R = 64: 0.51 ms, R = 128: 0.41 ms.
+So from R = 16 on it is faster than separate runs, and below that arn is
+better.
+
+=========================================================================== """
+
+import numpy as np
+import dynamics_network as dn
+import array_network as arn
+
+UNIT = dn.UNIT
+BALANCE = dn.BALANCE
+DELTA = dn.DELTA
+
+''' The arrays of BankArrays that are the same for all replicas '''
+TOPOLOGY = ['u', 'v', 'indptr', 'owner', 'nbr', 'eid', 'sgn', 'degree']
+
+''' R replicas of the state of a network on the same topology. The state
+    arrays (arn.STATE) get a first dimension for the replica, so
+    capital[r, i] is the capital of bank i in replica r and debt[r, e] is the
+    debt of edge e in replica r (with the sign convention of BankArrays).
+    All replicas start from the state of the given BankArrays. The topology
+    arrays are shared with it, and Tl and Ts are the same for all replicas. '''
+class BatchArrays(object):
+    def __init__(self, state, R):
+        self.R = R
+        self.N = state.N
+        self.Tl = state.Tl
+        self.Ts = state.Ts
+        for name in TOPOLOGY:
+            setattr(self, name, getattr(state, name))
+        self.hub_masks = state.hub_masks
+        for name in arn.STATE:
+            setattr(self, name, np.tile(getattr(state, name), (R, 1)))
+        self.replicas = [self._makeReplica(r) for r in range(R)]
+
+    ''' Which banks are hubs (see tn.hub_mask), the same for all replicas '''
+    def getHubMask(self, criterion = "mean", k = 1):
+        return self.replicas[0].getHubMask(criterion, k)
+
+    ''' Replica r as BankArrays, of which the state arrays are rows of the
+        arrays of the batch. Changing one changes the other. '''
+    def getReplica(self, r):
+        return self.replicas[r]
+
+    ''' Debts of all slots as seen from the owner of the slot, for every
+        replica (R x 2E) '''
+    def getViews(self):
+        return self.sgn * self.debt[:, self.eid]
+
+    def _makeReplica(self, r):
+        replica = arn.BankArrays(self.N, self.u, self.v, self.Tl, self.Ts, degree = self.degree,
+                                 csr = (self.indptr, self.owner, self.nbr, self.eid, self.sgn))
+        replica.hub_masks = self.hub_masks
+        for name in arn.STATE:
+            setattr(replica, name, getattr(self, name)[r])
+        return replica
+
+""" ===========================================================================
+
+SIMULATION
+
+=========================================================================== """
+
+''' Run the simulation for T iterations on R replicas of a network. network
+    is a network of Bank objects, BankArrays or BatchArrays (then R is taken
+    from it and the simulation goes on from its state). The network itself
+    isn't changed, use arn.to_network with batch.getReplica(r) to look at a
+    replica. Returns a list with the avalanche sizes of every replica.
+    It beats R separate runs of arn.run_simulation from about R = 16 on
+    (see the top of this file). '''
+def run_simulation(network, T, R = None, parameters = None, DEBUG_BOOL = False, seed = None):
+    avalanche_sizes = None
+    for t, sizes, depths in iterate_simulation(network, T, R, parameters, DEBUG_BOOL, seed):
+        if avalanche_sizes is None:
+            avalanche_sizes = [[] for size in sizes]
+        for r in np.flatnonzero(sizes >= 0):
+            avalanche_sizes[r].append(int(sizes[r]))
+    return avalanche_sizes
+
+''' Run the simulation for T iterations on R replicas as a generator, which
+    yields (step, avalanche sizes, cascade depths) after every step. The sizes
+    and depths are arrays with one value per replica, -1 and 0 for replicas
+    without an avalanche, like arn.iterate_simulation. '''
+def iterate_simulation(network, T, R = None, parameters = None, DEBUG_BOOL = False, seed = None):
+    # If no parameters were input, just use the default parameters
+    if parameters is None:
+        parameters = dn.default_parameters
+    print(parameters)
+    if isinstance(network, BatchArrays):
+        batch = network
+    elif R is None:
+        raise Exception("The number of replicas is needed to make a batch.")
+    elif isinstance(network, arn.BankArrays):
+        batch = BatchArrays(network, R)
+    else:
+        batch = BatchArrays(arn.from_network(network), R)
+    print("Tl is %i and Ts is %i, %i replicas" % (batch.Tl // UNIT, batch.Ts // UNIT, batch.R))
+    rng = np.random.RandomState(seed)
+
+    # Simulation kernel
+    for t in range(T):
+        avalanche_sizes = np.zeros(batch.R, dtype=np.int64) - 1
+        avalanche_depths = np.zeros(batch.R, dtype=np.int64)
+        _step(batch, parameters, rng, avalanche_sizes, avalanche_depths, t, DEBUG_BOOL)
+        yield t, avalanche_sizes, avalanche_depths
+
+''' One step of the simulation for all replicas '''
+def _step(batch, parameters, rng, avalanche_sizes, avalanche_depths, t, DEBUG_BOOL = False):
+    if t % 50 == 0:
+        print("ITERATION %i" % t)
+    # Generate random perturbations in the liquidity for each node of each replica
+    perturb(batch, rng)
+
+    # If the "too big to fail" policy is being implemented, hubs check if they can repay their government loan
+    # (arn works on R x N arrays just as well)
+    if parameters['too_big_to_fail']:
+        arn._repay_government_loan(batch)
+
+    # Banks with surplus liquidity try to repay debts
+    repay_debts(batch, parameters, rng)
+
+    # Banks with a deficit try to collect loans back
+    collect_loans(batch, parameters, rng)
+
+    # Banks with negative liquidity ask neighbors with surpluses to invest in them
+    ask_for_investments(batch, parameters, rng)
+
+    # Check for bankruptcy and propagate infection/failures
+    check_and_propagate_avalanche(batch, avalanche_sizes, parameters, rng, avalanche_depths)
+
+    # just checking the correctness of the program:
+    if DEBUG_BOOL:
+        debug(batch)
+
+''' Each bank of each replica gets or loses some capital randomly '''
+def perturb(batch, rng):
+    delta = (2 * rng.randint(0, 2, (batch.R, batch.N)) - 1) * DELTA
+    batch.liquidity += delta
+    batch.capital += delta
+    batch.delta[:] = delta
+
+''' Banks with surplus liquidity repay debts (see arn.repay_debts) '''
+def repay_debts(batch, parameters, rng):
+    for rows, banks, liquidity in _in_lockstep(batch, rng, parameters, "repay_debts"):
+        surplus = liquidity > BALANCE
+        quick = (liquidity < BALANCE) & (batch.delta[rows, banks] > 0) & bool(parameters['quick_repaying'])
+        acting = np.flatnonzero(surplus | quick)
+        if len(acting) == 0:
+            continue
+        rows, banks, liquidity, surplus = rows[acting], banks[acting], liquidity[acting], surplus[acting]
+        k, g, view = _counterparties(batch, rows, banks, rng, "lenders")
+        debt = -view
+        money = np.zeros(len(k), dtype=np.int64)
+        # Repay debt to lenders if I have a surplus
+        paying = surplus[g]
+        if parameters['diversify_trade'] == False:
+            money[paying] = arn._in_line_in_groups(debt[paying], g[paying], liquidity - BALANCE)
+        elif parameters['diversify_trade'] == True:
+            money[paying] = arn._split_evenly_in_groups(debt[paying], g[paying], liquidity - BALANCE, parameters)
+        else:
+            raise Exception("Parameter doesn't exist. (Spelled wrong probably)")
+        # If this node is broke, but 'quick_repaying' is on, and we got some money this round, pay back a random debt
+        first = ~paying & (np.arange(len(g)) == np.searchsorted(g, g))
+        money[first] = batch.delta[rows[g[first]], banks[g[first]]]
+        _transfer(batch, rows, banks, k, g, money)
+
+''' Banks with negative liquidity collect loans (see arn.collect_loans) '''
+def collect_loans(batch, parameters, rng):
+    for rows, banks, liquidity in _in_lockstep(batch, rng, parameters, "collect_loans"):
+        acting = np.flatnonzero(liquidity < BALANCE)
+        if len(acting) == 0:
+            continue
+        rows, banks, liquidity = rows[acting], banks[acting], liquidity[acting]
+        k, g, debt = _counterparties(batch, rows, banks, rng, "borrowers")
+        if parameters['diversify_trade'] == False:
+            # Take back whole loans until a loan is bigger than what I need, then take what I need from that one
+            money = arn._whole_loans_in_groups(debt, g, np.abs(liquidity))
+        elif parameters['diversify_trade'] == True:
+            money = arn._split_evenly_in_groups(debt, g, BALANCE - liquidity, parameters)
+        else:
+            raise Exception("Parameter doesn't exist. (Spelled wrong probably)")
+        _transfer(batch, rows, banks, k, g, -money)
+
+''' Banks with negative liquidity ask neighbors with surpluses to invest in
+    them (see arn.ask_for_investments) '''
+def ask_for_investments(batch, parameters, rng):
+    for rows, banks, liquidity in _in_lockstep(batch, rng, parameters, "ask_for_investments"):
+        acting = np.flatnonzero((liquidity < BALANCE) & (batch.capital[rows, banks] < BALANCE))
+        if len(acting) == 0:
+            continue
+        rows, banks, liquidity = rows[acting], banks[acting], liquidity[acting]
+        k, g, surplus = _counterparties(batch, rows, banks, rng, "rich")
+        if parameters['diversify_trade'] == False:
+            # Take all the surplus of rich neighbours until I have what I need
+            money = arn._in_line_in_groups(surplus, g, BALANCE - liquidity)
+        elif parameters['diversify_trade'] == True:
+            money = arn._split_evenly_in_groups(surplus - BALANCE, g, BALANCE - liquidity, parameters)
+        else:
+            raise Exception("Parameter doesn't exist. (Spelled wrong probably.)")
+        if dn._get_parameter(parameters, 'synchronous_settlement'):
+            # A rich bank can be asked by several banks at once (see arn._share_out)
+            giver = rows[g] * batch.N + batch.nbr[k]
+            money = arn._share_out(money, giver, (batch.liquidity - BALANCE).ravel())
+        _transfer(batch, rows, banks, k, g, -money)
+
+''' Check the thresholds of all banks in all replicas at once, and spread the
+    infection in the replicas where banks went bankrupt, one replica at a
+    time (see arn.check_and_propagate_avalanche). The size and depth of the
+    avalanche of replica r are written in avalanche_sizes[r] and
+    avalanche_depths[r]. '''
+def check_and_propagate_avalanche(batch, avalanche_sizes, parameters, rng, avalanche_depths = None):
+    bankrupt = (batch.capital <= batch.Ts) | (batch.liquidity <= batch.Tl)
+    batch.bankruptcy |= bankrupt
+    batch.infection |= bankrupt
+    for r in np.flatnonzero(bankrupt.any(axis=1)):
+        sizes, depths = [], []
+        arn._propagate_avalanche(batch.getReplica(r), np.flatnonzero(bankrupt[r]), sizes, parameters, rng, depths)
+        if len(sizes) > 0:
+            avalanche_sizes[r] = sizes[0]
+            if avalanche_depths is not None:
+                avalanche_depths[r] = depths[0]
+
+''' arn.debug for all replicas at once '''
+def debug(batch):
+    view = batch.getViews()
+    total_debt = np.zeros((batch.R, batch.N), dtype=np.int64)
+    np.add.at(total_debt, (np.arange(batch.R)[:, None], batch.owner), view)
+    if not np.array_equal(batch.capital, total_debt + batch.liquidity):
+        raise Exception("Capital isn't right!")
+    lending, borrowing = _lending_and_borrowing(batch, view)
+    if (lending & borrowing).any():
+        raise Exception("A node is borrowing and lending at the same time. This shouldn't happen!")
+
+""" ===========================================================================
+
+HELPER FUNCTIONS
+
+Many banks (one per replica) act at the same time. Their slots are put one
+after another, and g says which of them (the group) a slot belongs to. The
+groups are always sorted, so the slots of a group are next to each other.
+
+=========================================================================== """
+
+''' Go through the banks of every replica in its own random order. Yields,
+    for every position in the order, the replicas, the bank at that position
+    in each replica and its liquidity. Only the banks that can act in the
+    phase get a place in the order (see _can_act), the others would do
+    nothing, so there are as many positions as the replica with the most of
+    them has banks that can act. Among those, the order is the same as in
+    the permutation of all banks. With synchronous_settlement all banks of
+    all replicas act at once, so then everything is yielded in one go. '''
+def _in_lockstep(batch, rng, parameters, phase):
+    if dn._get_parameter(parameters, 'synchronous_settlement'):
+        rows, banks = np.divmod(np.arange(batch.R * batch.N), batch.N)
+        yield rows, banks, batch.liquidity[rows, banks]
+        return
+    keys = rng.random_sample((batch.R, batch.N))
+    can_act = _can_act(batch, phase, parameters)
+    keys[~can_act] = 2.  # Behind all the others
+    order = np.argsort(keys, axis=1)
+    count = can_act.sum(axis=1)
+    for n in range(count.max()):
+        rows = np.flatnonzero(count > n)
+        banks = order[rows, n]
+        yield rows, banks, batch.liquidity[rows, banks]
+
+''' Which banks of every replica can act at some point in the phase. The
+    liquidity of a bank only changes in repay_debts and collect_loans when
+    it pays, or when it is paid by a borrower or a lender. A payment turns a
+    lender into a borrower only when it goes over the debt, which can't
+    happen when all debts are multiples of DELTA (they aren't always with
+    too_big_to_fail), so otherwise the banks that could get new lenders or
+    borrowers are in too. Capital doesn't change in any of the phases. '''
+def _can_act(batch, phase, parameters):
+    liquidity = batch.liquidity
+    if phase == "ask_for_investments":
+        return (liquidity < BALANCE) & (batch.capital < BALANCE)
+    lending, borrowing = _lending_and_borrowing(batch, batch.getViews())
+    overshoot = (batch.debt % DELTA != 0).any(axis=1)[:, None]  # Per replica
+    if phase == "repay_debts":
+        quick = (liquidity < BALANCE) & (batch.delta > 0) & bool(parameters['quick_repaying'])
+        paying = borrowing & ((liquidity > BALANCE) | quick)
+        return paying | (lending & (borrowing | overshoot))
+    collecting = lending & (liquidity < BALANCE)
+    return collecting | (borrowing & (lending | overshoot))
+
+''' Which banks of every replica have borrowers (are lending) and which
+    have lenders (are borrowing), from the views of getViews '''
+def _lending_and_borrowing(batch, view):
+    lending = np.zeros((batch.R, batch.N), dtype=bool)
+    borrowing = np.zeros((batch.R, batch.N), dtype=bool)
+    r, k = np.nonzero(view > 0)
+    lending[r, batch.owner[k]] = True
+    r, k = np.nonzero(view < 0)
+    borrowing[r, batch.owner[k]] = True
+    return lending, borrowing
+
+''' Slots of the lenders, borrowers or rich neighbours of banks[n] in
+    replica rows[n], in random order within every group. Returns the slots,
+    their groups, and the debts as seen from the bank for lenders (-ve) and
+    borrowers (+ve), or the liquidity of the rich neighbours. '''
+def _counterparties(batch, rows, banks, rng, kind):
+    k = arn._slots_of(batch, banks)
+    g = np.repeat(np.arange(len(banks)), batch.indptr[banks + 1] - batch.indptr[banks])
+    if kind == "rich":
+        nbr = rows[g], batch.nbr[k]
+        value = batch.liquidity[nbr]
+        keep = (batch.capital[nbr] > BALANCE) & (value > BALANCE)
+    else:
+        value = batch.sgn[k] * batch.debt[rows[g], batch.eid[k]]
+        keep = value < 0 if kind == "lenders" else value > 0
+    k, g, value = k[keep], g[keep], value[keep]
+    order = np.lexsort((rng.random_sample(len(k)), g))
+    return k[order], g[order], value[order]
+
+''' Transfer money[n] from bank banks[g[n]] to the neighbour in slot k[n], in
+    replica rows[g[n]], and update the debts (like arn._transfer). '''
+def _transfer(batch, rows, banks, k, g, money):
+    total = np.zeros(len(banks), dtype=np.int64)
+    np.add.at(total, g, money)
+    batch.liquidity[rows, banks] -= total
+    # With synchronous_settlement a neighbour can get money from several banks at once
+    np.add.at(batch.liquidity, (rows[g], batch.nbr[k]), money)
+    # Only one of the two banks of an edge acts on it, so there are no repeated edges
+    batch.debt[rows[g], batch.eid[k]] += batch.sgn[k] * money
+
+
+if __name__ == '__main__':
+    print("Run the main you idiot!")
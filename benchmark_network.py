@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+""" ===========================================================================
+
+This script is where we benchmark the simulation, so that we know how fast
+it is and notice when a change makes it slower. It measures:
+    - steps per second of both simulations (dn and arn), on every generator
+      of generate_network at several sizes, with every combination of
+      diversify_trade, panic_collection and too_big_to_fail,
+    - the time it takes to generate each network, and the parts of the mean
+      field generator (_compute_lending_freq, mean_field_edges and
+      _mean_field_graph) on their own,
+    - the peak memory of all of the above (with tracemalloc, in a separate
+      run, because tracing makes everything slower).
+The results are saved as json in BENCHMARK_DIR, and compared with the
+baseline there. The first results become the baseline. Run it like:
+    python benchmark_network.py
+
+=========================================================================== """
+
+import os
+import io
+import sys
+import json
+import time
+import platform
+import itertools
+import contextlib
+import tracemalloc
+import random
+import numpy as np
+import networkx as nx
+import generate_network as gn
+import dynamics_network as dn
+import array_network as arn
+
+BENCHMARK_DIR = "BENCHMARKS"
+BASELINE = os.path.join(BENCHMARK_DIR, "baseline.json")
+TOLERANCE = 0.2  # Being this much worse than the baseline counts as a regression
+
+SIZES = [100, 1000]
+STEPS = 200  # Steps of every simulation
+MEMORY_STEPS = 20  # Steps of the simulations that measure memory
+Tl, Ts = -4, -6
+
+''' The generators, as functions of the (rough) number of banks '''
+GENERATORS = {"regular" : lambda N: gn.regular_network(int(round(N**0.5)), 2, Tl, Ts),
+              "random" : lambda N: gn.random_network(N, 4.0 / N, Tl, Ts),
+              "barabasi_albert" : lambda N: gn.barabasi_albert_network(N, 2, Tl, Ts),
+              "mean_field" : lambda N: gn.mean_field_network(N, Tl, Ts)}
+
+''' The simulations to benchmark '''
+ENGINES = {"objects" : dn.run_simulation,
+           "arrays" : arn.run_simulation}
+
+''' The parameters that are varied, all combinations are run '''
+VARIED_PARAMETERS = ["diversify_trade", "panic_collection", "too_big_to_fail"]
+
+''' Run all benchmarks and return their results, a dictionary of
+    benchmark name : measurements '''
+def run_benchmarks(sizes = SIZES, T = STEPS, generators = None, engines = None, seed = 0):
+    if generators is None:
+        generators = GENERATORS
+    if engines is None:
+        engines = ENGINES
+    results = {}
+    for N in sizes:
+        results.update(benchmark_mean_field_parts(N, seed))
+        for name in sorted(generators):
+            results.update(benchmark_generator(name, generators[name], N, T, engines, seed))
+    return results
+
+''' Benchmark the parts of the mean field generator '''
+def benchmark_mean_field_parts(N, seed = 0):
+    results = {}
+    credit_ratings = gn._compute_credit_ratings(N)
+    parts = {"lending_freq_matrix" : lambda: gn._compute_lending_freq(credit_ratings, 0.52),
+             "lending_freq_ratings" : lambda: gn._compute_lending_freq(credit_ratings, 0.52, return_matrix = False),
+             "mean_field_edges" : lambda: gn.mean_field_edges(N),
+             "mean_field_graph" : lambda: gn._mean_field_graph(N, Tl, Ts, 1, 0.52)}
+    for part in sorted(parts):
+        seconds = _timed(parts[part], seed)[1]
+        peak = _peak_memory(parts[part], seed)
+        results["generate/%s/%i" % (part, N)] = {"seconds" : seconds, "peak_memory" : peak}
+        print("%s N=%i: %.4f s, %.1f MB" % (part, N, seconds, peak / 1e6))
+    return results
+
+''' Benchmark generating a network with a generator, and simulating T steps
+    on it with every engine and parameter combination '''
+def benchmark_generator(name, generator, N, T = STEPS, engines = None, seed = 0):
+    if engines is None:
+        engines = ENGINES
+    results = {}
+    network, seconds = _timed(lambda: generator(N), seed)
+    peak = _peak_memory(lambda: generator(N), seed)
+    results["generate/%s/%i" % (name, N)] = {"seconds" : seconds, "peak_memory" : peak,
+                                             "nodes" : network.number_of_nodes(),
+                                             "edges" : network.number_of_edges()}
+    print("generate %s N=%i: %.4f s, %.1f MB" % (name, N, seconds, peak / 1e6))
+
+    pristine = arn.snapshot(network)
+    for engine in sorted(engines):
+        simulate = engines[engine]
+        for parameters in parameter_combinations():
+            flags = ",".join("%s=%i" % (p, parameters[p]) for p in VARIED_PARAMETERS)
+            arn.restore(network, pristine)
+            avalanche_sizes, seconds = _timed(lambda: simulate(network, T, parameters, seed = seed), seed)
+            arn.restore(network, pristine)
+            peak = _peak_memory(lambda: simulate(network, MEMORY_STEPS, parameters, seed = seed), seed)
+            results["simulate/%s/%i/%s/%s" % (name, N, engine, flags)] = {"seconds" : seconds,
+                                                                        "steps_per_second" : T / seconds,
+                                                                        "peak_memory" : peak,
+                                                                        "avalanches" : len(avalanche_sizes)}
+            print("simulate %s N=%i %s %s: %.1f steps/s, %.1f MB" % (name, N, engine, flags, T / seconds, peak / 1e6))
+    arn.restore(network, pristine)
+    return results
+
+''' All combinations of the varied parameters, on top of the defaults '''
+def parameter_combinations():
+    combinations = []
+    for values in itertools.product([False, True], repeat=len(VARIED_PARAMETERS)):
+        parameters = dict(dn.default_parameters)
+        parameters.update(zip(VARIED_PARAMETERS, values))
+        combinations.append(parameters)
+    return combinations
+
+''' Save results (with a description of the machine) as json, returns the
+    path. The first results that are saved also become the baseline. '''
+def save_results(results, path = None):
+    if not os.path.isdir(BENCHMARK_DIR):
+        os.makedirs(BENCHMARK_DIR)
+    if path is None:
+        path = os.path.join(BENCHMARK_DIR, time.strftime("results_%Y%m%d_%H%M%S.json"))
+    out = {"machine" : _describe_machine(), "results" : results}
+    with open(path, "w") as f:
+        json.dump(out, f, indent=1, sort_keys=True)
+    if not os.path.exists(BASELINE):
+        with open(BASELINE, "w") as f:
+            json.dump(out, f, indent=1, sort_keys=True)
+    return path
+
+''' Load saved results '''
+def load_results(path = BASELINE):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+''' Compare results with a baseline. Returns the regressions as a list of
+    (benchmark, measurement, baseline value, new value): everything that got
+    more than tolerance slower or uses more than tolerance more memory. '''
+def compare_results(results, baseline, tolerance = TOLERANCE):
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        new, old = results[name], baseline[name]
+        # Higher is worse for these, except for steps per second
+        for measurement in ["seconds", "peak_memory"]:
+            if measurement in new and measurement in old and new[measurement] > old[measurement] * (1 + tolerance):
+                regressions.append((name, measurement, old[measurement], new[measurement]))
+        if "steps_per_second" in new and "steps_per_second" in old:
+            if new["steps_per_second"] < old["steps_per_second"] / (1 + tolerance):
+                regressions.append((name, "steps_per_second", old["steps_per_second"], new["steps_per_second"]))
+    return regressions
+
+""" ===========================================================================
+
+HELPER FUNCTIONS
+
+=========================================================================== """
+
+''' Call function (seeded, with its printing hidden) and return its result
+    and the wall time it took '''
+def _timed(function, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+    return result, seconds
+
+''' Peak memory (in bytes) allocated while calling function '''
+def _peak_memory(function, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return peak
+
+''' What the results depend on besides the code '''
+def _describe_machine():
+    return {"platform" : platform.platform(),
+            "processor" : platform.processor(),
+            "python" : sys.version.split()[0],
+            "numpy" : np.__version__,
+            "networkx" : nx.__version__}
+
+
+if __name__ == '__main__':
+    results = run_benchmarks()
+    had_baseline = os.path.exists(BASELINE)
+    print("Saved results in %s" % save_results(results))
+    if had_baseline:
+        regressions = compare_results(results, load_results(BASELINE))
+        for name, measurement, old, new in regressions:
+            print("REGRESSION %s %s: %.4g -> %.4g" % (name, measurement, old, new))
+        print("%i regressions compared to %s" % (len(regressions), BASELINE))
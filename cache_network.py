@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+""" ===========================================================================
+
+This script is a cache around the generators in generate_network. Calling a
+generator with the same parameters and seed a second time loads the stored
+network (in the format of store_network) instead of generating it again.
+The cache lives on disk and is bounded in size: when it grows too big, the
+networks that were used least recently are removed.
+
+Tl and Ts are not part of the key, since they don't change the network
+itself, so networks are shared between thresholds.
+
+Use it like the generators, with an extra seed:
+    network = cn.mean_field_network(1000, -4, -6, seed = 1)
+
+=========================================================================== """
+
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import generate_network as gn
+import array_network as arn
+import store_network as sn
+
+CACHE_DIR = "NETWORK_CACHE"
+MAX_BYTES = 2 * 1024**3  # Size of the cache on disk
+
+''' Generate a network with generator (a function of generate_network) and
+    the given arguments, or load it from the cache if it was generated
+    before with the same arguments and seed. Without a seed the network is
+    random, so it is just generated and not cached.
+    The seed is passed on to generators that draw random numbers, so the
+    random module and np.random are left alone.
+    With as_arrays the network is returned as BankArrays (for
+    array_network), else as a network of Bank objects. '''
+def cached_network(generator, *args, seed = None, as_arrays = False, cache_dir = CACHE_DIR, max_bytes = MAX_BYTES, **kwargs):
+    arguments = inspect.signature(generator).bind(*args, **kwargs)
+    arguments.apply_defaults()
+    arguments = dict(arguments.arguments)
+    Tl, Ts = arguments.pop('Tl'), arguments.pop('Ts')
+    arguments.pop('seed', None)
+
+    if seed is None:
+        network = generator(*args, **kwargs)
+        return arn.from_network(network) if as_arrays else network
+
+    key = _network_key(generator, arguments, seed)
+    path = os.path.join(cache_dir, key)
+    if os.path.isdir(path):
+        # Mark it as recently used
+        os.utime(path, None)
+    else:
+        if 'seed' in inspect.signature(generator).parameters:
+            kwargs['seed'] = seed
+        network = generator(*args, **kwargs)
+        _store(network, path, generator, arguments, seed)
+        _evict(cache_dir, max_bytes, keep = path)
+
+    if as_arrays:
+        network = sn.load_arrays(path)
+        network.Tl, network.Ts = Tl * arn.UNIT, Ts * arn.UNIT
+    else:
+        network = sn.load_network(path)
+        network.graph['Tl'], network.graph['Ts'] = Tl, Ts
+    return network
+
+''' The generators of generate_network, with the cache in front of them '''
+def regular_network(L, d, Tl, Ts, **kwargs):
+    return cached_network(gn.regular_network, L, d, Tl, Ts, **kwargs)
+
+def random_network(N, p, Tl, Ts, **kwargs):
+    return cached_network(gn.random_network, N, p, Tl, Ts, **kwargs)
+
+def barabasi_albert_network(N, m, Tl, Ts, **kwargs):
+    return cached_network(gn.barabasi_albert_network, N, m, Tl, Ts, **kwargs)
+
+def mean_field_network(N, Tl, Ts, c = 1, m = 0.52, **kwargs):
+    return cached_network(gn.mean_field_network, N, Tl, Ts, c, m, **kwargs)
+
+''' Remove everything from the cache '''
+def clear_cache(cache_dir = CACHE_DIR):
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+""" ===========================================================================
+
+HELPER FUNCTIONS
+
+=========================================================================== """
+
+''' The key of a network is the hash of its generator, arguments and seed '''
+def _network_key(generator, arguments, seed):
+    description = {"generator" : "%s.%s" % (generator.__module__, generator.__name__),
+                   "arguments" : sorted(arguments.items()),
+                   "seed" : seed}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+''' Save a network in the cache. It is written to a temporary directory
+    first, so that other processes never see half a network '''
+def _store(network, path, generator, arguments, seed):
+    tmp_path = "%s.tmp%i" % (path, os.getpid())
+    sn.save_network(network, tmp_path)
+    with open(os.path.join(tmp_path, "key.json"), "w") as f:
+        json.dump({"generator" : generator.__name__, "arguments" : sorted(arguments.items()), "seed" : seed}, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process stored the same network in the meantime
+        shutil.rmtree(tmp_path)
+
+''' Remove the least recently used networks until the cache fits in
+    max_bytes. The network at keep is never removed '''
+def _evict(cache_dir, max_bytes, keep):
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not ".tmp" in name:
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+if __name__ == '__main__':
+    print("Run the main you idiot!")
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+""" ===========================================================================
+
+This script is where we record who infected whom in an avalanche, while it
+spreads, instead of working it out afterwards from the banks that defaulted.
+Pass a list as cascades to run_simulation, step_simulation or
+check_and_propagate_avalanche (in dynamics_network or array_network), and a
+Cascade is appended to it for every avalanche. Banks are numbers, in the
+order of network.nodes() (see topology_network).
+
+Every infection is an edge from a source bank to a target bank:
+    - a bankrupt source makes its lender (the target) lose the loan,
+    - an infected source collects its loan back from its borrower (the
+      target), which infects the borrower.
+The money of an edge is the loan that was lost or collected. A bank can be
+infected along several edges; its parent is the source of the first one.
+
+=========================================================================== """
+
+import numpy as np
+import networkx as nx
+
+''' Who infected whom in one avalanche. While the avalanche spreads, the
+    engine adds the bankruptcies and infections of every round. After
+    finish, everything is in arrays:
+    - banks: the banks of the avalanche, in the order they joined it,
+    - parent: the bank that infected each of them first (-1 for the banks
+      that went bankrupt first),
+    - round: the round each of them joined in (0 for the first bankrupt
+      banks, 1 for their lenders, and so on),
+    - bankrupt: whether each of them went bankrupt,
+    - source, target, edge_round, money: all infections, in order. '''
+class Cascade(object):
+    def __init__(self, position = None):
+        self.position = position  # bank : number, when the banks are objects (like in dynamics_network)
+        self.rounds = 0
+        self.edges = []  # (sources, targets, money, round) of every call of addInfections
+        self.bankruptcies = []  # Bankrupt banks of every call of addBankruptcies
+
+    ''' RECORDING, done by the engine '''
+    def nextRound(self):
+        self.rounds += 1
+
+    def addBankruptcies(self, banks):
+        self.bankruptcies.append(np.asarray(self._numbers(banks), dtype=np.int64))
+
+    def addInfections(self, sources, targets, money):
+        if len(targets) > 0:
+            self.edges.append((self._numbers(sources), self._numbers(targets), money, self.rounds))
+
+    def _numbers(self, banks):
+        if self.position is None:
+            return banks
+        return [self.position[bank] for bank in banks]
+
+    ''' Turn what was recorded into the arrays '''
+    def finish(self):
+        if len(self.edges) > 0:
+            self.source = np.concatenate([np.asarray(s, dtype=np.int64) for s, _, _, _ in self.edges])
+            self.target = np.concatenate([np.asarray(t, dtype=np.int64) for _, t, _, _ in self.edges])
+            self.money = np.concatenate([np.asarray(m, dtype=np.int64) for _, _, m, _ in self.edges])
+            self.edge_round = np.repeat([r for _, _, _, r in self.edges], [len(t) for _, t, _, _ in self.edges]).astype(np.int64)
+        else:
+            self.source, self.target, self.money, self.edge_round = [np.zeros(0, dtype=np.int64) for _ in range(4)]
+        roots = self.bankruptcies[0]
+        bankrupt = np.concatenate(self.bankruptcies)
+        # Every bank joins with the first edge that reaches it
+        targets, first = np.unique(self.target, return_index=True)
+        first = first[~np.in1d(targets, roots)]
+        first.sort()
+        self.banks = np.concatenate((roots, self.target[first]))
+        self.parent = np.concatenate((np.zeros(len(roots), dtype=np.int64) - 1, self.source[first]))
+        self.round = np.concatenate((np.zeros(len(roots), dtype=np.int64), self.edge_round[first]))
+        self.bankrupt = np.in1d(self.banks, bankrupt)
+        self.edges = self.bankruptcies = self.position = None
+        return self
+
+    ''' ANALYSIS '''
+    ''' Number of banks that got infected and didn't go bankrupt, which is
+        the avalanche size '''
+    def getSize(self):
+        return int((~self.bankrupt).sum())
+
+    ''' The last round in which a bank joined '''
+    def getDepth(self):
+        return int(self.round.max())
+
+    ''' Number of banks that every bank infected first, for the banks that
+        infected any '''
+    def getChildren(self):
+        return np.unique(self.parent[self.parent >= 0], return_counts=True)[1]
+
+    ''' Mean number of banks infected first by a bank that infected any '''
+    def getBranchingFactor(self):
+        children = self.getChildren()
+        if len(children) == 0:
+            return 0.
+        return children.mean()
+
+    ''' Number of banks that joined in every round '''
+    def getRoundSizes(self):
+        return np.bincount(self.round)
+
+    ''' The cascade tree as a DiGraph from parent to child, with the round
+        and bankruptcy of every bank. With nodes (for example network.nodes()),
+        the banks are nodes[i] instead of numbers. '''
+    def getTree(self, nodes = None):
+        label = (lambda i: i) if nodes is None else (lambda i: nodes[i])
+        tree = nx.DiGraph()
+        for bank, parent, r, bankrupt in zip(self.banks.tolist(), self.parent.tolist(), self.round.tolist(), self.bankrupt.tolist()):
+            tree.add_node(label(bank), round=r, bankrupt=bankrupt)
+            if parent >= 0:
+                tree.add_edge(label(parent), label(bank))
+        return tree
+
+
+if __name__ == '__main__':
+    print("Run the main you idiot!")
@@ -10,128 +10,304 @@ import random
 import networkx as nx
 import analyze_network as an
 import numpy as np
+import multiprocessing
+import pickle
+import os
+import time
+import copy
+import heapq
+import itertools
+import topology_network as tn
+import cascade_network as cn
 
 UNIT = 100  # Multiply everything by this value
 BALANCE = 0 * UNIT
 DELTA = 100
+ACTIVE_KEY = "active"  # Key of the ActiveBanks in network.graph while a simulation schedules
+CHANGED_KEY = "changed"  # Key of the set of banks that changed since the last audit in network.graph while a simulation checks
+PAYING, COLLECTING, ASKING = 1, 2, 4  # Flags of the active sets a bank is in (see ActiveBanks)
 
 ''' Default dictionary of parameters which vary the implementation details '''
 default_parameters = {"quick_repaying" : True,
                       "diversify_trade" : True,
                       "too_big_to_fail" : False,
-                      "panic_collection" : True}
+                      "panic_collection" : True,
+                      "closed_form_settlement" : True,
+                      "synchronous_settlement" : False,
+                      "clearing_cascade" : False,
+                      "hub_criterion" : "mean",
+                      "hub_k" : 1}
 
-''' Run the simulation for T iterations '''
-def run_simulation(network, T, parameters = None, DEBUG_BOOL = False):
+''' Record of every step written by stream_simulation '''
+STREAM_DTYPE = np.dtype([('step', np.int64), ('avalanche_size', np.int64), ('depth', np.int64)])
+
+''' Run the simulation for T iterations.
+    If stats is True (or a SimulationStats to add to), the time, transfers
+    and so on of every phase are recorded, and (avalanche sizes, stats) is
+    returned instead of just the avalanche sizes. If cascades is a list, the
+    cn.Cascade of every avalanche (who infected whom) is appended to it.
+    With DEBUG_BOOL, the ledger and the running totals of the debts are
+    checked on every change, and at the end of every step no bank that
+    changed may borrow and lend at once, all in O(1) per bank. Every
+    audit_interval steps, every bank
+    that changed since the last audit is audited fully, and audit_size
+    random banks on top of that, or all banks (the full check) if audit_size
+    is None. '''
+def run_simulation(network, T, parameters = None, DEBUG_BOOL = False, seed = None, stats = None, cascades = None, audit_interval = 50, audit_size = 20):
+    if stats is True:
+        stats = SimulationStats()
+    avalanche_sizes = []  # list of the sizes of all avalanches
+    for t, avalanche_size, depth in iterate_simulation(network, T, parameters, DEBUG_BOOL, seed, stats, cascades, audit_interval, audit_size):
+        if avalanche_size >= 0:
+            avalanche_sizes.append(avalanche_size)
+    # Return the list of avalanche sizes
+    if stats is not None:
+        return avalanche_sizes, stats
+    return avalanche_sizes
+
+''' Run the simulation for T iterations as a generator, which yields
+    (step, avalanche size, cascade depth) after every step. The depth is the
+    number of rounds the avalanche took. Steps without an avalanche yield
+    size -1 and depth 0. If stats (a SimulationStats) is given, it is filled
+    in along the way, and if cascades (a list) is given, the cn.Cascade of
+    every avalanche is appended to it. DEBUG_BOOL, audit_interval and
+    audit_size are like in run_simulation. '''
+def iterate_simulation(network, T, parameters = None, DEBUG_BOOL = False, seed = None, stats = None, cascades = None, audit_interval = 50, audit_size = 20):
     # If no parameters were input, just use the default parameters
     if parameters is None:
         parameters = default_parameters
+    # All random numbers of the run come from its own generator, so that a run with a seed can be reproduced
+    rng = RandomStream(seed)
     print(parameters)
     print("Tl is %i and Ts is %i" % (network.graph['Tl'], network.graph['Ts']))
     
     # Multiply the Ts and Tl with UNIT so that we can just input -4/-6 in main, but here there converted appropriately to -400/-600
+    Tl, Ts = network.graph['Tl'], network.graph['Ts']
     network.graph['Tl'] *= UNIT
     network.graph['Ts'] *= UNIT
+    # Check the ledger on every change (in O(1)), and audit the banks that changed every audit_interval steps
+    if DEBUG_BOOL:
+        _start_checking(network)
+    if stats is not None:
+        _start_stats(network, stats)
+    # Only visit the banks that can act in the settlement phases
+    _start_scheduling(network, parameters)
     
-    avalanche_sizes = []  # list of the sizes of all avalanches
-    # Simulation kernel
-    for t in range(T):
-        if t % 50 == 0:
-            print("ITERATION %i" % t)
-        # Generate random perturbations in the liquidity for each node
-        perturb(network)
-
-        # If the "too big to fail" policy is being implemented, these nodes should check if they can repay their government loan
-        if parameters['too_big_to_fail']:
-            _repay_government_loan(network)
-
-        # Banks with surplus liquidity try to repay debts
-        repay_debts(network, parameters)
+    try:
+        # Simulation kernel
+        for t in range(T):
+            if t % 50 == 0:
+                print("ITERATION %i" % t)
+            avalanche_sizes, avalanche_depths = [], []
+            _step(network, parameters, avalanche_sizes, avalanche_depths, t, DEBUG_BOOL, stats, rng, cascades, audit_interval, audit_size)
+            if len(avalanche_sizes) > 0:
+                yield t, avalanche_sizes[0], avalanche_depths[0]
+            else:
+                yield t, -1, 0
+    finally:
+        # Put the thresholds back, so that the network can be used again
+        network.graph['Tl'], network.graph['Ts'] = Tl, Ts
+        if DEBUG_BOOL:
+            _stop_checking(network)
+        if stats is not None:
+            _stop_stats(network)
+        _stop_scheduling(network)
+
+''' Run the simulation and append the result of every step (see
+    iterate_simulation) to the binary file at path, as records of
+    STREAM_DTYPE. The records are written chunk_size steps at a time, so a
+    long run uses constant memory, and read_stream can read the file while
+    the run is still going. iterate can be arn.iterate_simulation instead. '''
+def stream_simulation(network, T, path, parameters = None, chunk_size = 10000, seed = None, iterate = None):
+    if iterate is None:
+        iterate = iterate_simulation
+    chunk = np.zeros(chunk_size, dtype=STREAM_DTYPE)
+    n = 0
+    with open(path, "ab") as f:
+        for record in iterate(network, T, parameters, seed = seed):
+            chunk[n] = record
+            n += 1
+            if n == chunk_size:
+                f.write(chunk.tobytes())
+                f.flush()
+                n = 0
+        f.write(chunk[:n].tobytes())
+
+''' Read the records written by stream_simulation, also while it is still
+    running. Steps without an avalanche have size -1. '''
+def read_stream(path):
+    # A chunk that is being written can be cut off, so only read whole records
+    count = os.path.getsize(path) // STREAM_DTYPE.itemsize
+    return np.fromfile(path, dtype=STREAM_DTYPE, count=count)
+
+''' One step of the simulation. Returns the infected banks of every round
+    of the avalanche (see check_and_propagate_avalanche) '''
+def _step(network, parameters, avalanche_sizes, avalanche_depths, t, DEBUG_BOOL = False, stats = None, rng = None, cascades = None, audit_interval = 50, audit_size = 20):
+    rng = _random(rng)
+    # Generate random perturbations in the liquidity for each node
+    _run_phase(stats, network, 'perturb', perturb, network, rng)
+
+    # If the "too big to fail" policy is being implemented, these nodes should check if they can repay their government loan
+    if parameters['too_big_to_fail']:
+        _run_phase(stats, network, 'repay_government_loan', _repay_government_loan, network)
+
+    # Banks with surplus liquidity try to repay debts
+    _run_phase(stats, network, 'repay_debts', repay_debts, network, parameters, rng)
  
-        # Banks with a deficit try to collect loans back
-        collect_loans(network, parameters)
+    # Banks with a deficit try to collect loans back
+    _run_phase(stats, network, 'collect_loans', collect_loans, network, parameters, rng)
   
-        # Banks with negative liquidity ask neighbors with surpluses to invest in them
-        ask_for_investments(network, parameters)
+    # Banks with negative liquidity ask neighbors with surpluses to invest in them
+    _run_phase(stats, network, 'ask_for_investments', ask_for_investments, network, parameters, rng)
+
+    # Check for bankruptcy and propagate infection/failures. If an avalanche happens, its size is appended to avalanche_sizes 
+    bankruptcies = _run_phase(stats, None, 'avalanche', check_and_propagate_avalanche, network, avalanche_sizes, parameters, avalanche_depths, stats, rng, cascades)
     
-        # Check for bankruptcy and propagate infection/failures. If an avalanche happens, its size is appended to avalanche_sizes 
-        check_and_propagate_avalanche(network, avalanche_sizes, parameters)
-        
-        # just checking the correctness of the program:
-        if DEBUG_BOOL:
+    # just checking the correctness of the program. The ledger is checked on every change, this also checks the rest
+    if DEBUG_BOOL:
+        _check_changed(network)
+    if DEBUG_BOOL and t % audit_interval == 0:
+        if audit_size is None:
             debug(network)
             debug2(network)
-        
-    # Return the list of avalanche sizes
-    return avalanche_sizes
+            network.graph[CHANGED_KEY].clear()  # All banks were audited
+        else:
+            _audit_changed(network)
+            audit(network, audit_size, random.Random(t))  # Own random generator, so the simulation doesn't change
+    if stats is not None:
+        stats.steps += 1
+    return bankruptcies
+
+''' Run independent replicas of the simulation on a pool of processes and
+    merge their avalanche sizes.
+    network is either a function that returns a new network (for example
+    functools.partial(gn.mean_field_network, 100, -4, -6)), the path of a
+    pickled network, or a network. Every replica works on its own copy.
+    Replica r is seeded with the r-th seed drawn from base_seed, so results
+    are reproducible and don't depend on the number of processes. (Every
+    replica gets its own RandomStream from its seed.)
+    simulate runs one replica, for example arn.run_simulation instead of
+    run_simulation. It has to take the seed as keyword argument.
+    Returns the merged avalanche sizes and the wall time of every replica, so
+    stragglers can be spotted. '''
+def run_ensemble(network, parameters, T, replicas, base_seed = 0, processes = None, simulate = None):
+    if simulate is None:
+        simulate = run_simulation
+    seeds = np.random.RandomState(base_seed).randint(0, 2**31 - 1, size=replicas)
+    tasks = [(network, parameters, T, int(seed), simulate) for seed in seeds]
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_run_replica, tasks, chunksize=1)
+    avalanche_sizes = []
+    wall_times = []
+    for replica_sizes, wall_time in results:
+        avalanche_sizes += replica_sizes
+        wall_times.append(wall_time)
+    return avalanche_sizes, wall_times
+
+''' Run one replica of run_ensemble (in a worker process) '''
+def _run_replica(task):
+    network, parameters, T, seed, simulate = task
+    start = time.time()
+    # Seed before the network is made, so that random networks are reproducible too
+    random.seed(seed)
+    np.random.seed(seed)
+    avalanche_sizes = simulate(_load_network(network), T, parameters, seed = seed)
+    return avalanche_sizes, time.time() - start
+
+''' Get a fresh network from a function that makes one, the path of a
+    pickled network, or a network (which is copied, since a simulation
+    changes the network it runs on) '''
+def _load_network(network):
+    if isinstance(network, str):
+        return pickle.load(open(network, "rb"))
+    elif callable(network):
+        return network()
+    return copy.deepcopy(network)
 
-''' Run the simulation for 1 iteration and return the list of defaulted banks'''
-def step_simulation(network, parameters = None):
+''' Run the simulation for 1 iteration and return the list of defaulted banks.
+    With stats, like run_simulation, (defaulted banks, stats) is returned.
+    rng is the RandomStream to use, pass the same one every step to make a
+    sequence of steps reproducible. With cascades (a list), the cn.Cascade
+    of the avalanche is appended to it. '''
+def step_simulation(network, parameters = None, stats = None, rng = None, cascades = None):
     # If no parameters were input, just use the default parameters
     if parameters is None:
         parameters = default_parameters
+    if stats is True:
+        stats = SimulationStats()
     
-    avalanche_sizes = []  # list of the sizes of all avalanches
-    # Generate random perturbations in the liquidity for each node
-    perturb(network)
-
-    # Banks with surplus liquidity try to repay debts
-    repay_debts(network, parameters)
- 
-    # Banks with a deficit try to collect loans back
-    collect_loans(network)
-  
-    # Banks with surplus liquidity try to invest in neighbors with negative liquidity 
-    invest_surplus_liquidity(network, parameters)
-    
-    # Check for bankruptcy and propagate infection/failures. If an avalanche happens, its size is appended to avalanche_sizes 
-    return check_and_propagate_avalanche(network, avalanche_sizes, parameters)
+    # The thresholds are multiplied with UNIT, the same as in iterate_simulation
+    Tl, Ts = network.graph['Tl'], network.graph['Ts']
+    network.graph['Tl'] *= UNIT
+    network.graph['Ts'] *= UNIT
+    if stats is not None:
+        _start_stats(network, stats)
+    try:
+        avalanche_sizes = []  # list of the sizes of all avalanches
+        defaults = _step(network, parameters, avalanche_sizes, None, 0, stats = stats, rng = rng, cascades = cascades)
+    finally:
+        network.graph['Tl'], network.graph['Ts'] = Tl, Ts
+        if stats is not None:
+            _stop_stats(network)
+    if stats is not None:
+        return defaults, stats
+    return defaults
 
 ''' =========================================================================== 
 FUNCTIONS USED IN run_simulation()
 =========================================================================== '''
 
 ''' Each bank gets or loses some capital randomly (delta=1 v delta=-1) '''
-def perturb(network):
-    for node in network.nodes():  # data=True makes it retrieve all extra attributes
-        # Randomly generate delta
+def perturb(network, rng = None):
+    rng = _random(rng)
+    nodes = network.nodes()
+    # Randomly generate all deltas at once
 #        scale = int((len(node.getNeighbours()))**0.5)
-        scale = 1
-        delta = random.choice([-DELTA*scale, DELTA*scale])
-        # Update liquidity and capital
-        node.changeLiquidity(delta)
-        node.changeCapital(delta)
-        # Nodes can base choices on this round's delta, so set it
+    scale = 1
+    deltas = (rng.signs(len(nodes)) * DELTA * scale).tolist()
+    for node, delta in zip(nodes, deltas):
+        # Nodes can base choices on this round's delta, so set it (first, the active sets look at it)
         node.delta = delta
+        # Update liquidity and capital
+        node.changeLiquidityAndCapital(delta)
         
 ''' Banks with surplus liquidity repay debts  '''
-def repay_debts(network, parameters):
-    # Iterate through the node list randomly
-    node_list = network.nodes()[:]
-    random.shuffle(node_list)
+def repay_debts(network, parameters, rng = None):
+    rng = _random(rng)
+    if _get_parameter(parameters, 'synchronous_settlement'):
+        _settle_synchronously(network, parameters, "repay_debts", rng)
+        return
+    # Iterate through the node list randomly (only the banks that can pay, while scheduling)
+    node_list = _visiting_order(network, "paying", rng)
     # Repay
-    _pay_money(node_list, parameters)
+    _pay_money(node_list, parameters, rng)
 
 
 ''' Banks with negative liquidity collect loans  '''
-def collect_loans(network, parameters):
-    # Iterate through the node list randomly
-    node_list = network.nodes()[:]
-    random.shuffle(node_list)
+def collect_loans(network, parameters, rng = None):
+    rng = _random(rng)
+    if _get_parameter(parameters, 'synchronous_settlement'):
+        _settle_synchronously(network, parameters, "collect_loans", rng)
+        return
+    # Iterate through the node list randomly (only the banks that can collect, while scheduling)
+    node_list = _visiting_order(network, "collecting", rng)
     # Collect loans
-    _get_money(node_list, parameters, infection_happening = False)
+    _get_money(node_list, parameters, infection_happening = False, rng = rng)
 
 
 ''' Banks with surplus liquidity try to invest in neighbors with negative liquidity '''
-def ask_for_investments(network, parameters):
-    # Iterate through the node list randomly
-    node_list = network.nodes()[:]
-    random.shuffle(node_list)
+def ask_for_investments(network, parameters, rng = None):
+    rng = _random(rng)
+    if _get_parameter(parameters, 'synchronous_settlement'):
+        _settle_synchronously(network, parameters, "ask_for_investments", rng)
+        return
+    # Iterate through the node list randomly (only the banks that need money, while scheduling)
+    node_list = _visiting_order(network, "asking", rng)
     for node in node_list:
         # If there's still liquidity left, help out any broke neighbors
         if node.getLiquidity() < BALANCE and node.getCapital() < BALANCE:  
             # Get a list of rich neighbours
-            node.updateRichNeighbours()  # First update the node's list
+            node.updateRichNeighbours(rng)  # First update the node's list
             rich_neighbours = node.getRichNeighbours()
             # If diversify_trade is false, pick random broke neighbors and invest in them
             if parameters['diversify_trade'] == False:
@@ -144,6 +320,13 @@ def ask_for_investments(network, parameters):
                         neighbour.transfer(node, -node.getLiquidity())  # Else transfer what I need                    
                         break
             # Else if diversify_trade is true, distribute investments evenly
+            elif parameters['diversify_trade'] == True and _get_parameter(parameters, 'closed_form_settlement'):
+                # Work out in one go what every rich neighbour invests
+                surpluses = [neighbour.getLiquidity() - BALANCE for neighbour in rich_neighbours]
+                investments = _even_split(surpluses, BALANCE - node.getLiquidity())
+                for neighbour, money in zip(rich_neighbours, investments):
+                    if money > 0:
+                        neighbour.transfer(node, money)
             elif parameters['diversify_trade'] == True:
                 # As long as I need, and there are rich neighbors get money from, keep collecting money
                 while node.getLiquidity() < BALANCE and len(rich_neighbours) > 0:
@@ -159,72 +342,338 @@ def ask_for_investments(network, parameters):
             else:
                 raise Exception("Parameter doesn't exist. (Spelled wrong probably.)")
   
-''' Check for bankrupty and spread infections. '''
-def check_and_propagate_avalanche(network, avalanche_sizes, parameters):
+''' Check for bankrupty and spread infections.
+    Only the start of an avalanche scans the whole network. After that a
+    worklist is kept: only banks that lost capital (lenders of new bankrupt
+    banks) or liquidity (borrowers that paid back an infected bank) can go
+    bankrupt, and only newly infected banks still have loans to collect. So
+    an avalanche costs time in proportion to its size, not to the network.
+    With too_big_to_fail, the hubs that lost money with their injection are
+    checked in the first round too (see _inject_hubs).
+    If avalanche_depths is given, the number of rounds is appended to it, and
+    if stats is given the rounds and banks that were checked are counted.
+    If cascades is given, who infected whom is recorded as the infections
+    happen, and the cn.Cascade is appended to it. '''
+def check_and_propagate_avalanche(network, avalanche_sizes, parameters, avalanche_depths = None, stats = None, rng = None, cascades = None):
+    if _get_parameter(parameters, 'clearing_cascade'):
+        raise Exception("The clearing cascade only exists in array_network (use arn.run_simulation).")
+    rng = _random(rng)
     # If any bank has gone bankrupt, start an infection. Also get a list of bankrupt banks
     bankrupt_banks = _find_bankruptcies(network)  # list of bankrupt banks is a list of names
     complete_list_of_bankruptcies = []
+    if stats is not None:
+        stats.nodes_scanned['avalanche'] += len(network)
 
     if len(bankrupt_banks) > 0:  # If there are bankrupt banks
-            
-        _infect_neighbours(bankrupt_banks)  # Sets lender neighbours of bankrupt banks to infected
-        infected_banks = _find_infections(network) # Put all infected banks in a list
+        all_bankrupt_banks = list(bankrupt_banks)
+        cascade = None
+        if cascades is not None:
+            cascade = cn.Cascade(tn.topology_index(network).position)
+            cascade.addBankruptcies(bankrupt_banks)
+            cascade.nextRound()
+        lenders = _infect_neighbours(bankrupt_banks, rng, cascade)  # Sets lender neighbours of bankrupt banks to infected
+        infected_banks = set(lenders)  # All infected (but not bankrupt) banks
         length_old_infections = len(infected_banks)
-        
+
         if len(infected_banks) > 0:  # When there are infections
             # If we're doing the 'too big to fail' policy, inject hubs with money
+            rechecked = []  # Banks to check for bankruptcy besides the lenders and borrowers
             if parameters['too_big_to_fail']:
-                _inject_hubs(network)
+                rechecked = _inject_hubs(network, parameters, rng)
+            new_infections = _unique(lenders)  # Infected banks that haven't collected their loans yet (a list, so the order is reproducible)
+            collected = set()
             while True:
-                # Within one iteration, all infected nodes collect money and infect neighbors, and new bankruptcies happen
-                _collect_money_and_spread_infection(infected_banks, parameters)  # Infected nodes collect money from neighbors and infect them
-                bankrupt_banks = _find_bankruptcies(network)  # Find any new bankruptcies                
-                _infect_neighbours(bankrupt_banks)  # Make neighbors of new bankruptcies also infected
-                infected_banks = _find_infections(network)  # Make list of all currently infected
-                complete_list_of_bankruptcies.append(infected_banks)
+                if cascade is not None:
+                    cascade.nextRound()
+                # Within one iteration, newly infected nodes collect money and infect neighbors, and new bankruptcies happen
+                borrowers = _collect_money_and_spread_infection(new_infections, parameters, rng, cascade)  # Infected nodes collect money from neighbors and infect them
+                collected.update(new_infections)
+                infected_banks.update(borrowers)
+                # Only lenders that lost capital, borrowers that paid and hubs that lost money can go bankrupt
+                bankrupt_banks = _find_new_bankruptcies(network, lenders + borrowers + rechecked)
+                if stats is not None:
+                    stats.nodes_scanned['avalanche'] += len(lenders) + len(borrowers) + len(rechecked)
+                rechecked = []
+                all_bankrupt_banks += bankrupt_banks
+                infected_banks.difference_update(bankrupt_banks)
+                if cascade is not None:
+                    cascade.addBankruptcies(bankrupt_banks)
+                lenders = _infect_neighbours(bankrupt_banks, rng, cascade)  # Make neighbors of new bankruptcies also infected
+                infected_banks.update(lenders)
+                new_infections = _unique(bank for bank in borrowers + lenders if not bank.getBankruptcy() and not bank in collected)
+                complete_list_of_bankruptcies.append(list(infected_banks))
 
                 # Check if there are new infections and if avalanche should be stopped
-                length_new_infections = len(infected_banks) 
+                length_new_infections = len(infected_banks)
                 if length_new_infections == length_old_infections:
                     avalanche_sizes.append(length_new_infections)
+                    if avalanche_depths is not None:
+                        avalanche_depths.append(len(complete_list_of_bankruptcies))
+                    if stats is not None:
+                        stats.avalanches += 1
+                        stats.avalanche_rounds += len(complete_list_of_bankruptcies)
+                    if cascade is not None:
+                        cascades.append(cascade.finish())
                     _cure_all(infected_banks)  # Cures infected banks
-                    _reset_all(bankrupt_banks)  # resets every bank
+                    _reset_all(all_bankrupt_banks)  # resets every bank
                     break
                 else:
                     length_old_infections = length_new_infections
         else:
             _reset_all(bankrupt_banks)
-    return np.ndarray.flatten(np.array(complete_list_of_bankruptcies))
+    # One flat array, the rounds have different lengths
+    return np.array(list(itertools.chain.from_iterable(complete_list_of_bankruptcies)), dtype=object)
 
 ''' =========================================================================== 
 HELPER FUNCTIONS
 =========================================================================== '''
 
-''' Helper function to Debug '''
+''' Helper function to Debug. Checks every bank, see audit for a cheaper check '''
 def debug(network):
     for node in network.nodes():
-        # if a node is a borrower and a lender, raise an exception
-        borrowing, lending = False, False
-        for neighbour in node.neighbours:
-            if node.neighbours[neighbour] > 0:
-                lending = True
-            elif node.neighbours[neighbour] < 0:
-                borrowing = True
-        node.isCapitalRight()
-        if borrowing and lending:
-            raise Exception("A node is borrowing and lending at the same time. This shouldn't happen!")
+        _audit_bank(node)
 
 def debug2(network):
     for node in network.nodes():
         node.lenderBorrowerSame()
 
-''' Helper function to iterate through a given node list and retrieve loaned money from neighbours '''
-def _get_money(node_list, parameters, infection_happening = False):
+''' Check a random sample of size banks (or all banks if there are fewer)
+    the way debug does '''
+def audit(network, size, rng = random):
+    nodes = network.nodes()
+    for node in rng.sample(nodes, min(size, len(nodes))):
+        _audit_bank(node)
+        node.lenderBorrowerSame()
+
+''' Check every bank that changed since the last time (see _start_checking)
+    the way debug does '''
+def _audit_changed(network):
+    changed = network.graph[CHANGED_KEY]
+    for node in changed:
+        _audit_bank(node)
+        node.lenderBorrowerSame()
+    changed.clear()
+
+''' Check that no bank that changed since the last audit borrows and lends
+    at the same time, in O(1) per bank: the borrowers and lenders are kept
+    up to date (see Bank._classify), and at the end of a step no bank is
+    bankrupt, so they are all the debts of the bank '''
+def _check_changed(network):
+    for node in network.graph[CHANGED_KEY]:
+        if node.indexed and len(node._borrowers) > 0 and len(node._lenders) > 0:
+            raise Exception("A node is borrowing and lending at the same time. This shouldn't happen!")
+
+''' Check everything about one bank that the ledger checks don't '''
+def _audit_bank(node):
+    # if a node is a borrower and a lender, raise an exception
+    borrowing, lending = False, False
+    for neighbour in node.neighbours:
+        if node.neighbours[neighbour] > 0:
+            lending = True
+        elif node.neighbours[neighbour] < 0:
+            borrowing = True
+    node.isCapitalRight()
+    if node.checking and not node.total_debt == node.getTotalDebt():
+        raise Exception("The running total of the debts is wrong!")
+    if borrowing and lending:
+        raise Exception("A node is borrowing and lending at the same time. This shouldn't happen!")
+
+''' Make every bank check its ledger when it changes (see Bank.checkLedger),
+    and keep the set of banks that changed for _audit_changed. Every bank
+    starts in it, so the first audit checks them all. '''
+def _start_checking(network):
+    changed = network.graph[CHANGED_KEY] = set(network.nodes())
+    for node in network.nodes():
+        node.startChecking(changed)
+    for node in network.nodes():
+        for neighbour in node.neighbours:
+            node.checkLedger(neighbour)
+
+def _stop_checking(network):
+    for node in network.nodes():
+        node.stopChecking()
+    network.graph.pop(CHANGED_KEY, None)
+
+''' Helper function for parameters that were added later on, so that older
+    parameter dictionaries (like the one in main) still work '''
+def _get_parameter(parameters, name):
+    return parameters.get(name, default_parameters[name])
+
+''' Closed form of the diversify_trade while loops, which hand out DELTA to
+    every counterparty in turn, as long as the counterparty is still owed
+    something and there is budget left. Instead of looping over units, it
+    computes the number of full rounds everyone takes part in (water
+    filling), and hands the units that are left to the first counterparties
+    in line. This is exactly what the loops do (see check_even_split), so
+    like them it only hands out whole units of DELTA: when the caps and
+    budget are multiples of DELTA no counterparty gets more than its cap and
+    min(budget, sum(caps)) is handed out, otherwise the last unit of a
+    counterparty can go over its cap, and the last unit over the budget.
+    Returns the amount for every counterparty. '''
+def _even_split(caps, budget):
+    if len(caps) == 0 or budget <= 0:
+        return [0] * len(caps)
+    units = [max(-(-cap // DELTA), 0) for cap in caps]  # Rounds a counterparty takes part in
+    units_left = -(-budget // DELTA)
+    # Find the number of full rounds
+    rounds = 0
+    for i, u in enumerate(sorted(units)):
+        still_open = len(units) - i
+        if (u - rounds) * still_open > units_left:
+            rounds += units_left // still_open
+            units_left = units_left % still_open
+            break
+        units_left -= (u - rounds) * still_open
+        rounds = u
+    else:
+        units_left = 0  # Everybody gets their cap
+    # Everybody gets the full rounds, and the first ones in line get an extra unit
+    out = []
+    for u in units:
+        got = min(u, rounds)
+        if u > rounds and units_left > 0:
+            got += 1
+            units_left -= 1
+        out.append(got * DELTA)
+    return out
+
+''' Check _even_split on random caps and budgets: it has to give the same
+    as the DELTA loop (_round_robin), and when they are multiples of DELTA
+    every counterparty gets between 0 and its cap, and min(budget,
+    sum(caps)) is handed out. Raises an Exception if not. '''
+def check_even_split(trials = 1000, seed = 0):
+    rng = random.Random(seed)
+    for _ in range(trials):
+        n = rng.randint(0, 8)
+        caps = [DELTA * rng.randint(0, 12) for _ in range(n)]
+        budget = DELTA * rng.randint(-2, 40)
+        out = _even_split(caps, budget)
+        if any(money < 0 or money > cap for money, cap in zip(out, caps)) or not sum(out) == max(min(budget, sum(caps)), 0):
+            raise Exception("The even split of %i over %s is wrong: %s" % (budget, caps, out))
+        if not out == _round_robin(caps, budget):
+            raise Exception("The even split of %i over %s isn't what the loop gives!" % (budget, caps))
+        caps = [rng.randint(-DELTA, 12 * DELTA) for _ in range(n)]
+        budget = rng.randint(-2 * DELTA, 40 * DELTA)
+        if not _even_split(caps, budget) == _round_robin(caps, budget):
+            raise Exception("The even split of %i over %s isn't what the loop gives!" % (budget, caps))
+
+''' Synchronous settlement (see synchronous_settlement in main): every bank
+    decides what it pays, collects or asks for in the phase from the state at
+    the start of the phase, with the same rules as the sequential phases, and
+    then all transfers are made. In every phase only one of the two banks of
+    a debt acts on it, so the decisions don't clash, except that a rich bank
+    can be asked for money by several neighbours at once (see _share_out). '''
+def _settle_synchronously(network, parameters, phase, rng = random):
+    transfers = []  # (from, to, money)
+    for node in network.nodes():
+        liquidity = node.getLiquidity()
+        if phase == "repay_debts" and liquidity > BALANCE:
+            node.updateBorrowersLenders(rng)
+            lenders = node.getLenders()
+            payments = _split_budget([node.getDebt(lender) for lender in lenders], liquidity - BALANCE, parameters)
+            transfers += [(node, lender, money) for lender, money in zip(lenders, payments)]
+        elif phase == "repay_debts" and liquidity < BALANCE and parameters['quick_repaying'] and node.delta > 0:
+            node.updateBorrowersLenders(rng)
+            if len(node.getLenders()) > 0:
+                transfers.append((node, node.getLenders()[0], node.delta))
+        elif phase == "collect_loans" and liquidity < BALANCE:
+            node.updateBorrowersLenders(rng)
+            borrowers = node.getBorrowers()
+            debts = [node.getDebt(borrower) for borrower in borrowers]
+            if parameters['diversify_trade'] == False:
+                payments = _whole_loans(debts, abs(liquidity))
+            else:
+                payments = _split_budget(debts, BALANCE - liquidity, parameters)
+            transfers += [(borrower, node, money) for borrower, money in zip(borrowers, payments)]
+        elif phase == "ask_for_investments" and liquidity < BALANCE and node.getCapital() < BALANCE:
+            node.updateRichNeighbours(rng)
+            rich_neighbours = node.getRichNeighbours()
+            surpluses = [neighbour.getLiquidity() for neighbour in rich_neighbours]
+            if parameters['diversify_trade'] == True:
+                surpluses = [surplus - BALANCE for surplus in surpluses]
+            investments = _split_budget(surpluses, BALANCE - liquidity, parameters)
+            transfers += [(neighbour, node, money) for neighbour, money in zip(rich_neighbours, investments)]
+    if phase == "ask_for_investments":
+        transfers = _share_out(transfers)
+    for giver, receiver, money in transfers:
+        if money > 0:
+            giver.transfer(receiver, money)
+
+''' Split a budget over counterparties that each take at most their cap, in
+    the given order: one after another if diversify_trade is false, else
+    evenly (DELTA at a time, or in closed form) '''
+def _split_budget(caps, budget, parameters):
+    if parameters['diversify_trade'] == False:
+        return _in_line(caps, budget)
+    elif parameters['diversify_trade'] == True and _get_parameter(parameters, 'closed_form_settlement'):
+        return _even_split(caps, budget)
+    elif parameters['diversify_trade'] == True:
+        return _round_robin(caps, budget)
+    raise Exception("Parameter doesn't exist. (Spelled wrong probably)")
+
+''' Every counterparty takes its whole cap, until the budget is spent '''
+def _in_line(caps, budget):
+    out = []
+    for cap in caps:
+        out.append(min(cap, max(budget, 0)))
+        budget -= out[-1]
+    return out
+
+''' Whole loans are taken back until a loan is bigger than what is needed,
+    then what is needed is taken from that one (like _get_money) '''
+def _whole_loans(debts, money_needed):
+    out = []
+    enough = False
+    for debt in debts:
+        if enough:
+            out.append(0)
+        elif debt > money_needed:
+            out.append(money_needed)
+            enough = True
+        else:
+            out.append(debt)
+    return out
+
+''' Hand out the budget DELTA at a time, visiting the counterparties over
+    and over, like the diversify_trade while loops '''
+def _round_robin(caps, budget):
+    out = [0] * len(caps)
+    while budget > 0:
+        still_open = [i for i in range(len(caps)) if out[i] < caps[i]]
+        if len(still_open) == 0:
+            break
+        for i in still_open[:-(-budget // DELTA)]:
+            out[i] += DELTA
+            budget -= DELTA
+    return out
+
+''' A bank that is asked for more than it has gives every bank that asked
+    it its share of what it has, rounded down to DELTA so that all money
+    stays in units of DELTA. transfers is a list of (giver, receiver,
+    money) '''
+def _share_out(transfers):
+    asked = {}
+    for giver, receiver, money in transfers:
+        asked[giver] = asked.get(giver, 0) + money
+    shared = []
+    for giver, receiver, money in transfers:
+        available = giver.getLiquidity() - BALANCE
+        if asked[giver] > available:
+            money = money * available // asked[giver] // DELTA * DELTA
+        shared.append((giver, receiver, money))
+    return shared
+
+''' Helper function to iterate through a given node list and retrieve loaned money from neighbours.
+    Returns the borrowers that got infected when an infection is happening,
+    and adds these infections to cascade (a cn.Cascade) if it is given '''
+def _get_money(node_list, parameters, infection_happening = False, rng = random, cascade = None):
+    infected_borrowers = []
+    collectors, collected = [], []  # Who infected every borrower, and the loan it collected, for the cascade
     for node in node_list:
         # Collect money from borrowers if I have a deficit or if an infection is happening
         if node.getLiquidity() < 0 or infection_happening:
             # Get a list of the neighbors who have borrowed money from this node
-            node.updateBorrowersLenders()
+            node.updateBorrowersLenders(rng)
             borrowers = node.getBorrowers()
             if parameters['panic_collection'] and infection_happening:
                 money_needed = abs(node.getTotalDebt())
@@ -244,13 +693,25 @@ def _get_money(node_list, parameters, infection_happening = False):
                         # If this node is infected, infected the borrowing neighbour too
                         if infection_happening:
                             borrower.infect()
+                            infected_borrowers.append(borrower)
+                            if cascade is not None:
+                                collectors.append(node)
+                                collected.append(debt)
                     # Else take only the amount back we need to regain balance (liquidity = 0)
                     else:
                         node.transfer(borrower, -abs(money_needed)) 
                         if infection_happening:
                             borrower.infect()
+                            infected_borrowers.append(borrower)
                         break
             # If diversify_trade is true, distribute loan collecting evenly
+            elif parameters['diversify_trade'] == True and _get_parameter(parameters, 'closed_form_settlement'):
+                # Work out in one go how much every borrower pays back
+                debts = [node.getDebt(borrower) for borrower in borrowers]
+                payments = _even_split(debts, BALANCE - node.getLiquidity())
+                for borrower, money in zip(borrowers, payments):
+                    if money > 0:
+                        borrower.transfer(node, money)
             elif parameters['diversify_trade'] == True:
                 while node.getLiquidity() < BALANCE and len(borrowers) > 0:
                     remove_these = []  # Remove borrowers who have returned their debt
@@ -263,14 +724,17 @@ def _get_money(node_list, parameters, infection_happening = False):
                     borrowers = [b for b in borrowers if not b in remove_these]
             else:
                 raise Exception("Parameter doesn't exist. (Spelled wrong probably)")
+    if cascade is not None:
+        cascade.addInfections(collectors, infected_borrowers, collected)
+    return infected_borrowers
 
 ''' Helper function to iterate through a given node list and pay back debt to neighbours'''
-def _pay_money(node_list, parameters):
+def _pay_money(node_list, parameters, rng = random):
     for node in node_list:
         # Repay debt to lenders if I have a surplus
         if node.getLiquidity() > BALANCE:
             # Get a list of the neighbors who have loaned money to this node
-            node.updateBorrowersLenders()
+            node.updateBorrowersLenders(rng)
             lenders = node.getLenders()
             # If diversify_trade is false, pick a random lender and repay it all, and continue like this node-by-node
             if parameters['diversify_trade'] == False:
@@ -282,6 +746,13 @@ def _pay_money(node_list, parameters):
                         node.transfer(lender, node.getLiquidity())  # If I can't pay everything back, just give back what I have
                         break
             # If diversify_trade is true, keep transferring one unit to each lender until I'm out of money
+            elif parameters['diversify_trade'] == True and _get_parameter(parameters, 'closed_form_settlement'):
+                # Work out in one go how much every lender gets back
+                debts = [node.getDebt(lender) for lender in lenders]
+                payments = _even_split(debts, node.getLiquidity() - BALANCE)
+                for lender, money in zip(lenders, payments):
+                    if money > 0:
+                        node.transfer(lender, money)
             elif parameters['diversify_trade'] == True:
                 # As long as I have money, and there are lenders to give money to, keep giving them all 1 money
                 while node.getLiquidity() > BALANCE and len(lenders) > 0:
@@ -297,7 +768,7 @@ def _pay_money(node_list, parameters):
                 raise Exception("Parameter doesn't exist. (Spelled wrong probably)")
         # If this node is broke, but 'quick_repaying' is on, and we got some money this round, pay back a random debt
         elif node.getLiquidity() < BALANCE and parameters['quick_repaying'] and node.delta > 0:
-            node.updateBorrowersLenders()
+            node.updateBorrowersLenders(rng)
             if len(node.getLenders()) > 0:
                 lender = node.getLenders()[0]
                 node.transfer(lender, node.delta)
@@ -319,16 +790,33 @@ def _find_bankruptcies(network):
 #            print "hello", node.getCapital(), node.getLiquidity() 
     return bankrupt_banks
 
-'''Helper function for creating infections'''
-def _infect_neighbours(bankrupt_banks):
-    
+''' Helper function for checking if any of the given banks are now bankrupt.
+    Banks that already are bankrupt are skipped '''
+def _find_new_bankruptcies(network, banks):
+    bankrupt_banks = []
+    for node in banks:
+        if node.getBankruptcy():
+            continue
+        if node.getCapital() <= network.graph['Ts'] or node.getLiquidity() <= network.graph['Tl']:
+            node.setBankruptcy(True)
+            bankrupt_banks.append(node)
+    return bankrupt_banks
+
+'''Helper function for creating infections. Returns the lenders that got infected,
+    and adds these infections to cascade (a cn.Cascade) if it is given '''
+def _infect_neighbours(bankrupt_banks, rng = random, cascade = None):
+    infected_lenders = []
     for bank in bankrupt_banks:
-        bank.updateBorrowersLenders()
+        bank.updateBorrowersLenders(rng)
         lenders = bank.getLenders()
+        if cascade is not None:
+            cascade.addInfections([bank] * len(lenders), lenders, [lender.getDebt(bank) for lender in lenders])
 #        _debug2(network)
 #        print "hello", bank.getTotalDebt()
         for lender in lenders:
             lender.infect(bank)
+        infected_lenders += lenders
+    return infected_lenders
 
 '''Helper function to find infections'''
 def _find_infections(network):
@@ -339,8 +827,8 @@ def _find_infections(network):
     return infected_banks
 
 '''Helper function to cure infections'''
-def _collect_money_and_spread_infection(infected_banks, parameters):
-    _get_money(infected_banks, parameters, infection_happening = True)
+def _collect_money_and_spread_infection(infected_banks, parameters, rng = random, cascade = None):
+    return _get_money(infected_banks, parameters, infection_happening = True, rng = rng, cascade = cascade)
 #    _pay_money(infected_banks)
                     
 '''Helper function to cure Banks'''
@@ -352,23 +840,44 @@ def _cure_all(banks):
 def _reset_all(banks):
     for bank in banks:
         bank.reset()
+
+''' The banks without duplicates, in the order they first appear '''
+def _unique(banks):
+    seen = set()
+    out = []
+    for bank in banks:
+        if not bank in seen:
+            seen.add(bank)
+            out.append(bank)
+    return out
     
 ''' =========================================================================== 
 TOO BIG TO FAIL
 =========================================================================== '''
 
-# Inject all hubs with a temporary government loan
-def _inject_hubs(network):
-    hubs = _find_hubs(network)
-    for hub in hubs:
+''' Give every hub a government loan. Returns the hubs whose injection was
+    negative: these lost money and can be past a threshold now '''
+def _inject_hubs(network, parameters = None, rng = None):
+    if parameters is None:
+        parameters = default_parameters
+    rng = _random(rng)
+    hubs = _find_hubs(network, _get_parameter(parameters, 'hub_criterion'), _get_parameter(parameters, 'hub_k'))
+    fractions = rng.normal(0.44, 0.26, len(hubs)).tolist()
+    lost_money = []
+    for hub, fraction in zip(hubs, fractions):
         # injection size based on Karel's "policy implementations" file
-        injection = round(hub.capital - np.random.normal(0.44, 0.26) * (network.graph['Ts']))
+        injection = round(hub.capital - fraction * (network.graph['Ts']))
 #        injection = 100 * UNIT
+        # For a hub deep in debt (capital below fraction * Ts) the injection is negative and takes money
+        # away, like in the original policy. Then the hub has to be checked for bankruptcy again
+        if injection < 0:
+            lost_money.append(hub)
         hub.injection += injection
-        hub.capital += injection
-        hub.liquidity += injection
+        hub.changeCapital(injection)
+        hub.changeLiquidity(injection)
     # Add the hubs to the network attributes so that we can easily iterate over them later
     network.graph['hubs_with_loan'] = hubs
+    return lost_money
 
 # For all well-connected banks, hubs, that got an injection, repay this loan back if possible
 def _repay_government_loan(network):
@@ -378,45 +887,271 @@ def _repay_government_loan(network):
         injection = hub.injection
         # If I don't have enough, give all my liquidity back
         if liquidity > BALANCE and liquidity < injection:
-            hub.capital -= liquidity
-            hub.liquidity -= liquidity
+            hub.changeCapital(-liquidity)
+            hub.changeLiquidity(-liquidity)
             hub.injection -= liquidity
         # Else pay off the entire government loan
         elif liquidity > BALANCE and liquidity >= injection:
-            hub.capital -= injection
-            hub.liquidity -= injection
+            hub.changeCapital(-injection)
+            hub.changeLiquidity(-injection)
             hub.injection -= injection            
             # Remove any hubs from the list if their debt is paid off
             network.graph['hubs_with_loan'].remove(hub)
 
-# Return a list of all well-connected banks / hubs
-def _find_hubs(network):
-    average_degree = _compute_average_degree(network)
-    degree_sd = _compute_sd_degree(network, average_degree)
-    hubs = []
-    for node in network.nodes_iter():
-        if network.degree(node) > average_degree:
-            hubs.append(node)
-    return hubs
-
-# Standard deviation of the degree of the network
-def _compute_sd_degree(network, average_degree):
-    out = 0.0
+# Return a list of all well-connected banks / hubs (see tn.hub_mask for the criteria).
+# The degrees are only looked at once per network, the topology index keeps them
+def _find_hubs(network, criterion = "mean", k = 1):
+    return tn.topology_index(network).getHubs(criterion, k)
+
+''' =========================================================================== 
+RANDOM NUMBERS
+=========================================================================== '''
+
+''' The random numbers of one run, from its own np.random.RandomState. The
+    numbers for small shuffles are drawn block_size at a time, so there is
+    no overhead per call, and the signs and permutations are drawn for all
+    banks at once. Runs (or replicas) with different seeds get independent
+    streams, and a run with the same seed gets the same numbers, also in
+    another process. It has a shuffle like the random module, so it can be
+    passed to the Bank functions that shuffle. '''
+class RandomStream(object):
+    def __init__(self, seed = None, block_size = 65536):
+        self.state = np.random.RandomState(seed)
+        self.block_size = block_size
+        self.block = []
+        self.position = 0
+
+    ''' n random signs (+1 or -1) as an array '''
+    def signs(self, n):
+        return self.state.randint(0, 2, size=n) * 2 - 1
+
+    ''' A random permutation of range(n) as an array '''
+    def permutation(self, n):
+        return self.state.permutation(n)
+
+    ''' The items in random order, as a new list '''
+    def permuted(self, items):
+        return [items[i] for i in self.state.permutation(len(items)).tolist()]
+
+    def normal(self, mean, sd, size = None):
+        return self.state.normal(mean, sd, size)
+
+    ''' One uniform number in [0, 1) from the block '''
+    def random(self):
+        if self.position == len(self.block):
+            self.block = self.state.random_sample(self.block_size).tolist()
+            self.position = 0
+        self.position += 1
+        return self.block[self.position - 1]
+
+    ''' Shuffle a list in place (Fisher-Yates with numbers from the block) '''
+    def shuffle(self, items):
+        n = len(items)
+        if n < 2:
+            return
+        if self.position + n > len(self.block):
+            self.block = self.state.random_sample(max(self.block_size, n)).tolist()
+            self.position = 0
+        block, position = self.block, self.position
+        self.position += n - 1
+        for i in range(n - 1, 0, -1):
+            j = int(block[position] * (i + 1))
+            position += 1
+            items[i], items[j] = items[j], items[i]
+
+''' The given RandomStream, or a new one seeded from np.random when there
+    is none (for functions that are called on their own) '''
+def _random(rng):
+    if rng is None:
+        return RandomStream(np.random.randint(0, 2**31 - 1))
+    return rng
+
+''' =========================================================================== 
+ACTIVE SETS
+=========================================================================== '''
+
+''' The banks that can act in each settlement phase, kept up to date as
+    transfers happen (every Bank tells it about its changes, see
+    Bank.startScheduling), so a phase doesn't have to go through all banks:
+    - paying: banks with lenders and a surplus (or, with quick_repaying,
+      that are broke but got money this round),
+    - collecting: banks with borrowers and a deficit,
+    - asking: banks whose liquidity and capital are below BALANCE.
+    A phase still checks every bank it visits, like before. '''
+class ActiveBanks(object):
+    def __init__(self, quick_repaying = True):
+        self.quick_repaying = quick_repaying
+        self.paying, self.collecting, self.asking = {}, {}, {}  # Dictionaries of bank : None, as sets in a fixed order
+        self.member = {}  # bank : the sets it is in, as flags
+        self.watched = None  # The set the running phase goes through, and the Scheduler that visits it
+        self.scheduler = None
+        self.phases, self.visits = 0, 0  # Phases that went through a set, and banks they visited, so far
+
+    ''' Put bank in the sets it belongs in now, and out of the others. This
+        runs on every change of every bank, so it is quick when nothing changes '''
+    def update(self, bank):
+        liquidity = bank.liquidity
+        if liquidity < BALANCE:
+            member = (PAYING if self.quick_repaying and bank.delta > 0 and len(bank._lenders) > 0 else 0) | \
+                     (COLLECTING if liquidity < 0 and len(bank._borrowers) > 0 else 0) | \
+                     (ASKING if bank.capital < BALANCE else 0)
+        else:
+            member = PAYING if liquidity > BALANCE and len(bank._lenders) > 0 else 0
+        changed = member ^ self.member.get(bank, 0)
+        if changed == 0:
+            return
+        self.member[bank] = member
+        for flag, banks in ((PAYING, self.paying), (COLLECTING, self.collecting), (ASKING, self.asking)):
+            if changed & flag:
+                if member & flag:
+                    banks[bank] = None
+                    # A bank that can act now can still get its turn in the running phase
+                    if banks is self.watched:
+                        self.scheduler.offer(bank)
+                else:
+                    del banks[bank]
+
+    ''' Visit the banks of the named set in random order, including the
+        ones that join it while the phase runs (see Scheduler) '''
+    def schedule(self, name, rng):
+        self.phases += 1
+        self.watched = getattr(self, name)
+        self.scheduler = Scheduler(list(self.watched), rng)
+        try:
+            for bank in self.scheduler:
+                self.visits += 1
+                yield bank
+        finally:
+            self.watched = self.scheduler = None
+
+''' Visits banks in the order of a random permutation of all banks, but
+    only the ones that can act get a place in it. Every bank gets a random
+    key the first time it is offered, and the banks are visited in the order
+    of their keys. A bank offered after the visits passed its key is left
+    out, like a bank that could only act after its turn in the permutation.
+    The order is the same as a shuffle of all banks, without the skipping. '''
+class Scheduler(object):
+    def __init__(self, banks, rng):
+        self.rng = rng
+        self.keys = {}  # bank : key, for every bank offered
+        self.queue = []  # Heap of (key, tie breaker, bank) still to visit
+        self.now = -1.0  # Key of the bank visited last
+        for bank in banks:
+            self.offer(bank)
+
+    def offer(self, bank):
+        if not bank in self.keys:
+            key = self.rng.random()
+            self.keys[bank] = key
+            if key > self.now:
+                heapq.heappush(self.queue, (key, len(self.keys), bank))
+
+    def __iter__(self):
+        while len(self.queue) > 0:
+            self.now, _, bank = heapq.heappop(self.queue)
+            yield bank
+
+''' Keep the active sets of the network up to date from now on, until
+    _stop_scheduling '''
+def _start_scheduling(network, parameters):
+    active = ActiveBanks(parameters['quick_repaying'])
+    network.graph[ACTIVE_KEY] = active
     for node in network.nodes():
-        out += np.power((network.degree(node) - average_degree), 2)
-    return np.sqrt(out / len(network.nodes()))
+        node.startScheduling(active)
 
-# Average degree of the network
-def _compute_average_degree(network):
-    out = 0.0
+def _stop_scheduling(network):
     for node in network.nodes():
-        out += network.degree(node)
-    return out / len(network.nodes())
+        node.stopScheduling()
+    network.graph.pop(ACTIVE_KEY, None)
+
+''' The banks a phase visits, in random order: while scheduling, the banks
+    in the named active set, else all banks '''
+def _visiting_order(network, name, rng):
+    active = network.graph.get(ACTIVE_KEY)
+    if active is None:
+        return rng.permuted(network.nodes())
+    return active.schedule(name, rng)
+
+''' =========================================================================== 
+INSTRUMENTATION
+=========================================================================== '''
 
+''' The phases of a step, in order '''
+PHASES = ['perturb', 'repay_government_loan', 'repay_debts', 'collect_loans', 'ask_for_investments', 'avalanche']
 
+''' What a simulation spent its time on, per phase: the wall time, the number
+    of transfers and the money they moved, and the banks that were looked at.
+    Also the number of avalanches and the rounds they took in total.
+    Stats of several runs can be added up with merge. '''
+class SimulationStats(object):
+    def __init__(self):
+        self.steps = 0
+        self.time = dict.fromkeys(PHASES, 0.0)
+        self.transfers = dict.fromkeys(PHASES, 0)
+        self.money_moved = dict.fromkeys(PHASES, 0)
+        self.nodes_scanned = dict.fromkeys(PHASES, 0)
+        self.avalanches = 0
+        self.avalanche_rounds = 0
+        self.phase = None  # The phase that is running
 
+    ''' Called by Bank.transfer '''
+    def countTransfer(self, money):
+        self.transfers[self.phase] += 1
+        self.money_moved[self.phase] += abs(money)
 
+    ''' Add the stats of another run to these '''
+    def merge(self, other):
+        self.steps += other.steps
+        for phase in PHASES:
+            self.time[phase] += other.time[phase]
+            self.transfers[phase] += other.transfers[phase]
+            self.money_moved[phase] += other.money_moved[phase]
+            self.nodes_scanned[phase] += other.nodes_scanned[phase]
+        self.avalanches += other.avalanches
+        self.avalanche_rounds += other.avalanche_rounds
+        return self
 
+    def getTotalTime(self):
+        return sum(self.time.values())
+
+    ''' The phase that took the most time '''
+    def getSlowestPhase(self):
+        return max(PHASES, key=lambda phase: self.time[phase])
+
+    def __str__(self):
+        out = "%i steps, %i avalanches in %i rounds, %.3f s\n" % (self.steps, self.avalanches, self.avalanche_rounds, self.getTotalTime())
+        out += "%-22s %10s %10s %14s %12s\n" % ("phase", "time (s)", "transfers", "money moved", "scanned")
+        for phase in PHASES:
+            out += "%-22s %10.3f %10i %14i %12i\n" % (phase, self.time[phase], self.transfers[phase],
+                                                      self.money_moved[phase], self.nodes_scanned[phase])
+        return out
+
+''' Run one phase of a step, and time it if there are stats. If network is
+    given, every bank counts as scanned (the phase loops over all of them) '''
+def _run_phase(stats, network, phase, function, *args):
+    if stats is None:
+        return function(*args)
+    stats.phase = phase
+    # The settlement phases only visit the active banks when the network schedules
+    active = network.graph.get(ACTIVE_KEY) if network is not None else None
+    phases, visits = (active.phases, active.visits) if active is not None else (0, 0)
+    start = time.time()
+    result = function(*args)
+    stats.time[phase] += time.time() - start
+    if active is not None and active.phases > phases:
+        stats.nodes_scanned[phase] += active.visits - visits
+    elif network is not None:
+        stats.nodes_scanned[phase] += len(network)
+    return result
+
+''' Make every bank count its transfers in stats (see Bank.transfer) '''
+def _start_stats(network, stats):
+    for node in network.nodes():
+        node.stats = stats
+
+def _stop_stats(network):
+    for node in network.nodes():
+        node.stats = None
 
 
 if __name__ == '__main__':
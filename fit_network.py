@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+""" ===========================================================================
+
+This script is where we check whether the avalanche sizes follow a power law,
+with the method of Clauset, Shalizi and Newman ("Power-law distributions in
+empirical data", 2009) for discrete data:
+    - fit_power_law estimates x_min and the exponent alpha by maximum
+      likelihood, choosing the x_min with the smallest Kolmogorov-Smirnov
+      distance. All candidate x_min values are handled at once with suffix
+      sums over the histogram of the sizes.
+    - goodness_of_fit gives the bootstrap p-value of the power law.
+    - bootstrap_alpha gives a bootstrap confidence interval for alpha.
+    - compare_distributions does the likelihood ratio test against an
+      exponential or lognormal tail.
+The bootstraps are spread over a pool of processes.
+
+The avalanche sizes can be a list (like the one from dn.run_simulation) or
+an an.AvalancheStatistics. Avalanches of size 0 are ignored.
+
+=========================================================================== """
+
+import math
+import multiprocessing
+import numpy as np
+from scipy import special, optimize
+import analyze_network as an
+
+''' Fit a discrete power law to the tail of the avalanche sizes. If x_min is
+    not given, every size that leaves at least min_tail avalanches in the
+    tail is tried, and the one with the smallest KS distance is used.
+    Returns a dictionary with alpha, x_min, the number of avalanches in the
+    tail (n_tail) and the KS distance (ks). '''
+def fit_power_law(avalanche_sizes, x_min = None, min_tail = 10):
+    values, counts = _histogram(avalanche_sizes)
+    return _fit(values, counts, x_min, min_tail)
+
+''' Bootstrap p-value of the power law fit. Synthetic data sets are made
+    with the fitted power law above x_min and the data below it, and fitted
+    the same way. The p-value is the fraction of synthetic data sets that
+    fit worse than the data. Roughly, p < 0.1 rules out the power law. '''
+def goodness_of_fit(avalanche_sizes, fit = None, num_bootstrap = 1000, min_tail = 10, processes = None, seed = 0):
+    values, counts = _histogram(avalanche_sizes)
+    if fit is None:
+        fit = _fit(values, counts, None, min_tail)
+    tasks = [(values, counts, fit, min_tail, s) for s in _seeds(seed, num_bootstrap)]
+    with multiprocessing.Pool(processes) as pool:
+        ks = np.array(pool.map(_synthetic_ks, tasks))
+    return np.mean(ks >= fit['ks'])
+
+''' Bootstrap confidence interval for alpha (and the alphas of all
+    bootstrap samples). Every sample resamples the avalanches and fits
+    x_min and alpha again. '''
+def bootstrap_alpha(avalanche_sizes, num_bootstrap = 1000, confidence = 0.95, min_tail = 10, processes = None, seed = 0):
+    values, counts = _histogram(avalanche_sizes)
+    tasks = [(values, counts, min_tail, s) for s in _seeds(seed, num_bootstrap)]
+    with multiprocessing.Pool(processes) as pool:
+        alphas = np.array(pool.map(_resampled_alpha, tasks))
+    low, high = np.percentile(alphas, [50 * (1 - confidence), 50 * (1 + confidence)])
+    return (low, high), alphas
+
+''' Likelihood ratio test of the power law against another distribution
+    ('exponential' or 'lognormal') for the tail above x_min. Returns the
+    normalized log likelihood ratio R and its p-value (Vuong's test). R > 0
+    means the power law fits better, but only if p is small. '''
+def compare_distributions(avalanche_sizes, fit = None, alternative = 'exponential', min_tail = 10):
+    values, counts = _histogram(avalanche_sizes)
+    if fit is None:
+        fit = _fit(values, counts, None, min_tail)
+    tail = values >= fit['x_min']
+    x, c = values[tail], counts[tail]
+    power_law = _power_law_log_pmf(x, fit['alpha'], fit['x_min'])
+    if alternative == 'exponential':
+        other = _exponential_log_pmf(x, c, fit['x_min'])
+    elif alternative == 'lognormal':
+        other = _lognormal_log_pmf(x, c, fit['x_min'])
+    else:
+        raise Exception("Distribution doesn't exist. (Spelled wrong probably)")
+    difference = power_law - other
+    n = np.sum(c)
+    ratio = np.sum(c * difference)
+    sd = np.sqrt(np.sum(c * (difference - ratio / n)**2) / n)
+    R = ratio / (np.sqrt(n) * sd)
+    return R, math.erfc(abs(R) / np.sqrt(2))
+
+""" ===========================================================================
+
+HELPER FUNCTIONS
+
+=========================================================================== """
+
+''' The sizes that occur (at least 1) and how often '''
+def _histogram(avalanche_sizes):
+    if isinstance(avalanche_sizes, an.AvalancheStatistics):
+        values, counts = avalanche_sizes.getHistogram()
+    else:
+        values, counts = np.unique(np.asarray(avalanche_sizes, dtype=np.int64), return_counts=True)
+    keep = values > 0
+    return values[keep], counts[keep]
+
+''' Fit x_min and alpha to a histogram. The approximate maximum likelihood
+    alpha (eq. 3.7 of Clauset et al.) is computed for all candidates at once
+    from suffix sums. The KS distance needs the model distribution of every
+    candidate, so that loop stays. Alpha is then refined with the exact
+    discrete maximum likelihood at the chosen x_min. '''
+def _fit(values, counts, x_min, min_tail):
+    # Suffix sums over the histogram: number of avalanches and sum of log sizes from each value on
+    n_tail = np.cumsum(counts[::-1])[::-1]
+    log_sum = np.cumsum((counts * np.log(values))[::-1])[::-1]
+    if x_min is None:
+        candidates = np.flatnonzero(n_tail >= min_tail)
+        if len(candidates) == 0:
+            raise Exception("Not enough avalanches to fit a power law.")
+    else:
+        candidates = np.flatnonzero(values >= x_min)[:1]
+        if len(candidates) == 0:
+            raise Exception("No avalanches of size x_min or bigger.")
+    x_mins = values[candidates].astype(np.float64)
+    alphas = 1 + n_tail[candidates] / (log_sum[candidates] - n_tail[candidates] * np.log(x_mins - 0.5))
+
+    best = None
+    for k, alpha in zip(candidates, alphas):
+        ks = _ks_distance(values[k:], counts[k:], alpha, values[k])
+        if best is None or ks < best[0]:
+            best = (ks, k)
+    ks, k = best
+    alpha = _exact_alpha(values[k:], counts[k:], values[k])
+    return {'alpha' : alpha, 'x_min' : int(values[k]), 'n_tail' : int(n_tail[k]),
+            'ks' : _ks_distance(values[k:], counts[k:], alpha, values[k])}
+
+''' Exact maximum likelihood alpha of a discrete power law above x_min '''
+def _exact_alpha(values, counts, x_min):
+    n = np.sum(counts)
+    log_sum = np.sum(counts * np.log(values))
+    def negative_log_likelihood(alpha):
+        return n * np.log(special.zeta(alpha, x_min)) + alpha * log_sum
+    return optimize.minimize_scalar(negative_log_likelihood, bounds=(1.0001, 10), method='bounded').x
+
+''' Largest distance between the empirical and power law distributions
+    of the tail '''
+def _ks_distance(values, counts, alpha, x_min):
+    empirical = np.cumsum(counts) / np.sum(counts)
+    model = 1 - special.zeta(alpha, values + 1) / special.zeta(alpha, x_min)
+    return np.max(np.abs(empirical - model))
+
+def _power_law_log_pmf(x, alpha, x_min):
+    return -alpha * np.log(x) - np.log(special.zeta(alpha, x_min))
+
+''' Discrete exponential (geometric) above x_min, with the maximum
+    likelihood rate '''
+def _exponential_log_pmf(x, c, x_min):
+    mean_excess = np.sum(c * (x - x_min)) / np.sum(c)
+    rate = np.log(1 + 1 / max(mean_excess, 1e-12))
+    return np.log(1 - np.exp(-rate)) - rate * (x - x_min)
+
+''' Discrete lognormal above x_min, with maximum likelihood mu and sigma.
+    It is normalized by summing up to 10 times the largest size, since the
+    avalanches can't get much bigger than the network anyway. '''
+def _lognormal_log_pmf(x, c, x_min):
+    support = np.arange(x_min, 10 * np.max(x) + 1, dtype=np.float64)
+    def log_pmf(parameters, points):
+        mu, log_sigma = parameters
+        sigma = np.exp(log_sigma)
+        shape = lambda y: -np.log(y) - (np.log(y) - mu)**2 / (2 * sigma**2)
+        return shape(points) - special.logsumexp(shape(support))
+    def negative_log_likelihood(parameters):
+        return -np.sum(c * log_pmf(parameters, x))
+    logs = np.log(np.repeat(x, c))
+    start = [np.mean(logs), np.log(max(np.std(logs), 0.1))]
+    parameters = optimize.minimize(negative_log_likelihood, start, method='Nelder-Mead').x
+    return log_pmf(parameters, x)
+
+''' Independent seeds for the bootstrap samples '''
+def _seeds(seed, num):
+    return [int(s) for s in np.random.RandomState(seed).randint(0, 2**31 - 1, size=num)]
+
+''' Fit a resampled histogram and return its alpha (in a worker process) '''
+def _resampled_alpha(task):
+    values, counts, min_tail, seed = task
+    rng = np.random.RandomState(seed)
+    resampled = rng.multinomial(np.sum(counts), counts / np.sum(counts))
+    keep = resampled > 0
+    return _fit(values[keep], resampled[keep], None, min_tail)['alpha']
+
+''' Make a synthetic data set from the fit and return its KS distance after
+    fitting it (in a worker process) '''
+def _synthetic_ks(task):
+    values, counts, fit, min_tail, seed = task
+    rng = np.random.RandomState(seed)
+    n = np.sum(counts)
+    n_tail = rng.binomial(n, fit['n_tail'] / n)
+    # Below x_min, resample the data
+    below = values < fit['x_min']
+    if np.any(below):
+        body = rng.choice(values[below], size=n - n_tail, p=counts[below] / np.sum(counts[below]))
+    else:
+        body = np.zeros(0, dtype=np.int64)
+        n_tail = n
+    # Above x_min, draw from the power law (approximate inverse of eq. D.6 of Clauset et al.)
+    r = rng.rand(n_tail)
+    tail = np.floor((fit['x_min'] - 0.5) * (1 - r)**(-1 / (fit['alpha'] - 1)) + 0.5).astype(np.int64)
+    synthetic_values, synthetic_counts = np.unique(np.concatenate((body, tail)), return_counts=True)
+    return _fit(synthetic_values, synthetic_counts, None, min_tail)['ks']
+
+
+if __name__ == '__main__':
+    print("Run the main you idiot!")
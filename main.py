@@ -4,6 +4,8 @@ This script is where we adjust parameters and run the model
 =========================================================================== """
 import generate_network as gn
 import dynamics_network as dn
+import array_network as arn
+import batch_network as bn
 import analyze_network as an
 import networkx as nx
 import pickle
@@ -21,7 +23,26 @@ import pickle
     panic_collection - True/False. 'True' means that infected bank collects all
         money from all its borrower. 'False' means that bank only collects 
         back the lost capital
-    too_big_to_fail - policy, more description later...'''
+    too_big_to_fail - policy, more description later...
+    closed_form_settlement - True/False. 'True' means that with diversify_trade
+        the even split of payments is computed in one go instead of moving
+        DELTA at a time. The outcome is the same. (Optional, default True)
+    hub_criterion, hub_k - which banks are hubs for too_big_to_fail: 'mean'
+        (degree above the mean), 'sd' (degree above the mean + hub_k
+        standard deviations) or 'top' (the hub_k banks with the highest
+        degree). (Optional, default 'mean')
+    synchronous_settlement - True/False. 'True' means that in repay_debts,
+        collect_loans and ask_for_investments every bank decides from the
+        state at the start of the phase and all transfers happen at once,
+        instead of banks acting one after another in a random order. This is
+        a different model, but much faster in arn and bn. A rich bank that
+        is asked for more than it has gives everybody its share of it.
+        (Optional, default False)
+    clearing_cascade - True/False. 'True' means that an avalanche is worked
+        out as a fixed point (like a clearing vector) with sparse matrices,
+        instead of round by round: banks are judged on everything they paid
+        and collected in the avalanche at once. Only in arn and bn, for big
+        networks. (Optional, default False)'''
 parameters = {"quick_repaying" : True,
               "diversify_trade" : True,
               "too_big_to_fail" : False,  # (This one is useless in a regular grid)
@@ -33,18 +54,24 @@ parameters['repay_fraction'] = 1
 network = pickle.load(open("MEAN_FIELD_SAVED\mean_field_N100_tl-4_ts-6.pickle", "rb" ))
 network.graph['hubs'] = dn._find_hubs(network)
 print("hubs: %i" % len(network.graph['hubs']))
+pristine = arn.snapshot(network)  # Restore this instead of loading the pickle again for every run
 
 avalanche_sizes, avalanche_sizes2 = [], []
 
+# arn.run_simulation takes the same arguments as dn.run_simulation and is much
+# faster, because it keeps the state of the network in NumPy arrays
+# bn.run_simulation(network, T, R, parameters) runs R replicas of the network at
+# once, and gives a list with the avalanche sizes of every replica
+
 for i in range(1):
-    network = pickle.load(open("MEAN_FIELD_SAVED\mean_field_N100_tl-4_ts-6.pickle", "rb" ))
+    arn.restore(network, pristine)
     network.graph['Tl'] = -6
     network.graph['Ts'] = -10
     parameters['too_big_to_fail'] = False    
     
     avalanche_sizes += dn.run_simulation(network, 1000, parameters, DEBUG_BOOL = True)  # TURN OFF DEBUG_BOOL FOR SPEED (BUT TURN IT ON EVERY NOW AND THEN)
     
-    network = pickle.load(open("MEAN_FIELD_SAVED\mean_field_N100_tl-4_ts-6.pickle", "rb" ))
+    arn.restore(network, pristine)
     network.graph['Tl'] = -6
     network.graph['Ts'] = -10
     parameters['too_big_to_fail'] = False
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+""" ===========================================================================
+
+This script is where we save and load generated networks in a compact
+format, instead of pickling networkx graphs of Bank objects.
+
+A saved network is a directory with one .npy file per array and a
+meta.json with the graph attributes:
+    - the topology as an edge list (u, v), the CSR index of array_network
+      and the degree of every bank,
+    - the state of every bank (capital, liquidity, ...) and the debt on
+      every edge,
+    - Tl, Ts, hubs and hubs_with_loan.
+The topology is loaded memory-mapped and read-only, so worker processes that
+load the same network share one copy of it. The state is copied, because the
+simulation changes it.
+
+=========================================================================== """
+
+import os
+import json
+import pickle
+import numpy as np
+import networkx as nx
+import array_network as arn
+import generate_network as gn
+
+UNIT = arn.UNIT
+
+TOPOLOGY = ['u', 'v', 'degree', 'indptr', 'owner', 'nbr', 'eid', 'sgn']
+STATE = arn.STATE
+
+''' Save a network of Bank objects, or BankArrays, in the directory path '''
+def save_network(network, path):
+    if isinstance(network, arn.BankArrays):
+        state = network
+        Tl, Ts = state.Tl / UNIT, state.Ts / UNIT
+        hubs = None
+    else:
+        state = arn.from_network(network)
+        Tl, Ts = network.graph['Tl'], network.graph['Ts']
+        hubs = network.graph.get('hubs')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in TOPOLOGY + STATE:
+        np.save(os.path.join(path, name + ".npy"), getattr(state, name))
+    meta = {"N" : int(state.N), "Tl" : Tl, "Ts" : Ts}
+    if hubs is not None:
+        index = dict(zip(network.nodes(), range(state.N)))
+        meta["hubs"] = [index[hub] for hub in hubs]
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+''' Load a saved network as BankArrays (for array_network) '''
+def load_arrays(path, mmap = True):
+    meta, arrays = _load(path, mmap)
+    csr = tuple(arrays[name] for name in ['indptr', 'owner', 'nbr', 'eid', 'sgn'])
+    state = arn.BankArrays(meta['N'], arrays['u'], arrays['v'], meta['Tl'] * UNIT, meta['Ts'] * UNIT,
+                           arrays['debt'], arrays['degree'], csr)
+    for name in STATE[1:]:
+        getattr(state, name)[:] = arrays[name]
+    return state
+
+''' Load a saved network as a networkx network of Bank objects, the same as
+    the ones made by generate_network (for dynamics_network) '''
+def load_network(path):
+    meta, arrays = _load(path, mmap = True)
+    banks = gn.createBanks(meta['N'])
+    G = nx.Graph()
+    G.add_nodes_from(banks)
+    u, v = arrays['u'].tolist(), arrays['v'].tolist()
+    G.add_edges_from(zip([banks[i] for i in u], [banks[j] for j in v]))
+    # Self loops aren't in the edge list, but they still count for the degree
+    self_loops = np.asarray(arrays['degree']) - np.diff(arrays['indptr'])
+    G.add_edges_from((banks[i], banks[i]) for i in np.flatnonzero(self_loops))
+    for i, bank in enumerate(banks):
+        bank.setPosition(i)
+        bank.setCapital(int(arrays['capital'][i]))
+        bank.setLiquidity(int(arrays['liquidity'][i]))
+        bank.setBankruptcy(bool(arrays['bankruptcy'][i]))
+        bank.infection = bool(arrays['infection'][i])
+        bank.delta = int(arrays['delta'][i])
+        bank.injection = int(arrays['injection'][i])
+        bank.money_lost = int(arrays['money_lost'][i])
+    gn._assignNeighbours(G)
+    for e, debt in enumerate(arrays['debt'].tolist()):
+        banks[u[e]].neighbours[banks[v[e]]] = debt  # banks[v[e]] sees the same debt
+    G.graph['Tl'] = meta['Tl']
+    G.graph['Ts'] = meta['Ts']
+    G.graph['hubs_with_loan'] = [banks[i] for i in np.flatnonzero(arrays['hubs_with_loan'])]
+    if 'hubs' in meta:
+        G.graph['hubs'] = [banks[i] for i in meta['hubs']]
+    return G
+
+''' Convert a pickled network (like the ones in MEAN_FIELD_SAVED) to the
+    compact format. By default it is saved next to the pickle, with the same
+    name without .pickle '''
+def import_pickle(pickle_path, path = None):
+    if path is None:
+        path = os.path.splitext(pickle_path)[0]
+    network = pickle.load(open(pickle_path, "rb"))
+    save_network(network, path)
+    return path
+
+''' Read meta.json and all arrays. The topology is memory-mapped read-only
+    if mmap is True, the state is always copied '''
+def _load(path, mmap):
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    mmap_mode = 'r' if mmap else None
+    arrays = {}
+    for name in TOPOLOGY:
+        arrays[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+    for name in STATE:
+        arrays[name] = np.array(np.load(os.path.join(path, name + ".npy")))
+    return meta, arrays
+
+
+if __name__ == '__main__':
+    # Convert the saved pickles
+    for name in os.listdir("MEAN_FIELD_SAVED"):
+        if name.endswith(".pickle"):
+            print(import_pickle(os.path.join("MEAN_FIELD_SAVED", name)))
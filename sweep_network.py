@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+""" ===========================================================================
+
+This script is where we sweep over a grid of liquidity/solvency thresholds
+(Tl, Ts), policy flags and networks. All cells of the grid are run on a pool
+of processes. Every finished cell is cached on disk, keyed by its full
+configuration, so re-running a sweep after adding grid points only computes
+the new cells.
+
+=========================================================================== """
+
+import os
+import json
+import hashlib
+import itertools
+import functools
+import multiprocessing
+import random
+import numpy as np
+import dynamics_network as dn
+
+CACHE_DIR = "SWEEP_CACHE"
+
+''' Run a sweep and return a dictionary that maps every cell
+    (network name, Tl, Ts, policy) to an array of its avalanche sizes, ready
+    for analyze_network.histogram_avalanches.
+    networks - dictionary of name : network, where the network is anything
+        dn.run_ensemble accepts (a function that makes a network, the path
+        of a pickled network or a network). For networks that are neither
+        a path nor a functools.partial of a generator the name is part of
+        the cache key, so give different networks different names.
+    Tl_values, Ts_values - the thresholds to sweep over (like -4, -6).
+    policies - dictionary of parameter name : list of values to sweep over,
+        for example {"too_big_to_fail" : [False, True]}. A policy in the
+        result is a tuple of (name, value) pairs.
+    parameters - the other parameters, dn.default_parameters if None.
+    Every cell runs replicas independent simulations of T iterations, seeded
+    from base_seed the same way in every cell. '''
+def run_sweep(networks, Tl_values, Ts_values, T, policies = None, parameters = None, replicas = 1,
+              base_seed = 0, processes = None, simulate = None, cache_dir = CACHE_DIR):
+    if simulate is None:
+        simulate = dn.run_simulation
+    seeds = [int(seed) for seed in np.random.RandomState(base_seed).randint(0, 2**31 - 1, size=replicas)]
+    cells = sweep_cells(networks, Tl_values, Ts_values, policies)
+
+    results = {}
+    tasks = []
+    for cell in cells:
+        name, Tl, Ts, policy = cell
+        config = _cell_config(networks[name], name, Tl, Ts, policy, parameters, T, replicas, base_seed, simulate)
+        cached = load_cell(config, cache_dir)
+        if cached is None:
+            cell_parameters = dict(config['parameters'])
+            tasks.append((cell, config, networks[name], Tl, Ts, cell_parameters, T, seeds, simulate))
+        else:
+            results[cell] = cached
+    print("%i cells in the sweep, %i of them cached" % (len(cells), len(cells) - len(tasks)))
+
+    # Run the new cells, and cache every cell as soon as it is done
+    if len(tasks) > 0:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with multiprocessing.Pool(processes) as pool:
+            for cell, config, avalanche_sizes in pool.imap_unordered(_run_cell, tasks):
+                _save_cell(config, avalanche_sizes, cache_dir)
+                results[cell] = avalanche_sizes
+    return results
+
+''' List all cells (network name, Tl, Ts, policy) of a sweep '''
+def sweep_cells(networks, Tl_values, Ts_values, policies = None):
+    if policies is None:
+        policies = {}
+    names = sorted(policies)
+    combinations = [tuple(zip(names, values)) for values in itertools.product(*[policies[name] for name in names])]
+    return list(itertools.product(sorted(networks), Tl_values, Ts_values, combinations))
+
+''' Load the avalanche sizes of a cell from the cache, or None if the cell
+    hasn't been computed yet '''
+def load_cell(config, cache_dir = CACHE_DIR):
+    path = os.path.join(cache_dir, _cell_key(config) + ".npz")
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return data['avalanche_sizes']
+
+""" ===========================================================================
+
+HELPER FUNCTIONS
+
+=========================================================================== """
+
+''' Run all replicas of one cell (in a worker process) '''
+def _run_cell(task):
+    cell, config, network, Tl, Ts, parameters, T, seeds, simulate = task
+    avalanche_sizes = []
+    for seed in seeds:
+        # Seed before the network is made, so that random networks are reproducible too
+        random.seed(seed)
+        np.random.seed(seed)
+        replica = dn._load_network(network)
+        replica.graph['Tl'] = Tl
+        replica.graph['Ts'] = Ts
+        avalanche_sizes += simulate(replica, T, parameters, seed = seed)
+    return cell, config, np.array(avalanche_sizes, dtype=np.int64)
+
+''' The full configuration of a cell, everything its result depends on '''
+def _cell_config(network, name, Tl, Ts, policy, parameters, T, replicas, base_seed, simulate):
+    if parameters is None:
+        parameters = dn.default_parameters
+    cell_parameters = dict(dn.default_parameters)
+    cell_parameters.update(parameters)
+    cell_parameters.update(policy)
+    return {"network" : _describe(network, name),
+            "Tl" : Tl,
+            "Ts" : Ts,
+            "parameters" : sorted(cell_parameters.items()),
+            "T" : T,
+            "replicas" : replicas,
+            "base_seed" : base_seed,
+            "simulate" : _describe(simulate, None)}
+
+''' A description of a network (or function) that stays the same between
+    runs, unlike its repr which holds a memory address '''
+def _describe(thing, name):
+    if isinstance(thing, str):
+        return thing
+    elif isinstance(thing, functools.partial):
+        return [_describe(thing.func, name), list(thing.args), sorted(thing.keywords.items())]
+    elif hasattr(thing, '__module__') and hasattr(thing, '__name__'):
+        return "%s.%s" % (thing.__module__, thing.__name__)
+    return name
+
+''' The cache key of a cell is the hash of its configuration '''
+def _cell_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+''' Save the avalanche sizes of a cell, together with its configuration so
+    the cache can be read by hand. The file is written under a temporary
+    name first so an interrupted sweep never leaves a broken cell behind. '''
+def _save_cell(config, avalanche_sizes, cache_dir):
+    path = os.path.join(cache_dir, _cell_key(config))
+    np.savez(path + ".tmp.npz", avalanche_sizes=avalanche_sizes, config=json.dumps(config, sort_keys=True))
+    os.replace(path + ".tmp.npz", path + ".npz")
+
+
+if __name__ == '__main__':
+    print("Run the main you idiot!")
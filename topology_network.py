@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+""" ===========================================================================
+
+This script is where we index the topology of a network once, instead of
+looping over all nodes every time the degrees or hubs are needed. The
+topology doesn't change during a simulation, so the index is stored in
+network.graph and reused until the network changes:
+    - the degree of every bank, and its mean and standard deviation,
+    - the neighbours of every bank as offsets into one array (like CSR),
+    - the hubs under several criteria (see hub_mask).
+Banks are numbered in the order of network.nodes().
+
+After adding or removing banks or edges, call invalidate_topology (a change
+in the number of banks is noticed by itself).
+
+=========================================================================== """
+
+import itertools
+import numpy as np
+
+INDEX_KEY = "topology"  # Key of the index in network.graph
+
+''' The ways to pick hubs, see hub_mask '''
+HUB_CRITERIA = ["mean", "sd", "top"]
+
+''' The topology index of a network, built the first time it is asked for '''
+def topology_index(network):
+    index = network.graph.get(INDEX_KEY)
+    if index is None or not index.number_of_nodes == len(network):
+        index = TopologyIndex(network)
+        network.graph[INDEX_KEY] = index
+    return index
+
+''' Throw the index away, after the topology changed '''
+def invalidate_topology(network):
+    network.graph.pop(INDEX_KEY, None)
+
+''' Which banks are hubs, given the degrees:
+    'mean' - banks with a degree above the mean (what too big to fail used),
+    'sd' - banks with a degree above the mean + k standard deviations,
+    'top' - the k banks with the highest degree. '''
+def hub_mask(degree, criterion = "mean", k = 1):
+    degree = np.asarray(degree)
+    if len(degree) == 0:
+        return np.zeros(0, dtype=bool)
+    if criterion == "mean":
+        return degree > degree.mean()
+    elif criterion == "sd":
+        return degree > degree.mean() + k * degree.std()
+    elif criterion == "top":
+        mask = np.zeros(len(degree), dtype=bool)
+        mask[np.argsort(-degree, kind='mergesort')[:int(k)]] = True
+        return mask
+    raise Exception("Hub criterion doesn't exist. (Spelled wrong probably)")
+
+''' Degrees, neighbours and hubs of a network. The neighbours of bank i are
+    neighbours[offsets[i]:offsets[i+1]] (as numbers, see position) '''
+class TopologyIndex(object):
+    def __init__(self, network):
+        self.nodes = list(network.nodes())
+        self.number_of_nodes = len(self.nodes)
+        self.position = dict(zip(self.nodes, range(self.number_of_nodes)))
+        self.degree = np.array([network.degree(node) for node in self.nodes], dtype=np.int64)
+        neighbours = [[self.position[neighbour] for neighbour in network.neighbors(node)] for node in self.nodes]
+        self.offsets = np.zeros(self.number_of_nodes + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(n) for n in neighbours])
+        self.neighbours = np.array(list(itertools.chain.from_iterable(neighbours)), dtype=np.int64)
+        self.hub_masks = {}  # (criterion, k) : mask
+
+    def getMeanDegree(self):
+        return self.degree.mean()
+
+    def getSdDegree(self):
+        return self.degree.std()
+
+    def getNeighbours(self, i):
+        return self.neighbours[self.offsets[i]:self.offsets[i + 1]]
+
+    ''' Which banks are hubs (see hub_mask), computed once per criterion '''
+    def getHubMask(self, criterion = "mean", k = 1):
+        if not (criterion, k) in self.hub_masks:
+            self.hub_masks[(criterion, k)] = hub_mask(self.degree, criterion, k)
+        return self.hub_masks[(criterion, k)]
+
+    ''' The hubs as a new list of banks '''
+    def getHubs(self, criterion = "mean", k = 1):
+        return [self.nodes[i] for i in np.flatnonzero(self.getHubMask(criterion, k))]
+
+
+if __name__ == '__main__':
+    print("Run the main you idiot!")